@@ -0,0 +1,507 @@
+#
+#   pygruta CMS
+#   ttcdt <dev@triptico.com>
+#
+#   This software is released into the public domain.
+#
+
+#   Gruta source Cached (in-memory, read-through copy of another source)
+
+import time, threading
+
+from pygruta.base import Gruta
+
+
+class Cached(Gruta):
+    def __init__(self, source):
+        self.source = source
+
+        # seconds between checks for external modifications
+        self.check_interval = 5
+
+        # the in-memory data is shared by the httpd threads
+        self.lock = threading.RLock()
+
+        # changes on every reset, write or invalidation, so that
+        # data loaded meanwhile (maybe outdated) is not stored
+        self.gen = 0
+
+        self._reset()
+
+        # init the base class
+        super().__init__()
+
+    def id(self):
+        return "Cached (%s)" % self.source.id()
+
+    def _flush(self):
+        self._write(self.source._flush)
+
+    def timed_flush(self):
+        r = super().timed_flush()
+
+        # (the source may have its own periodic work)
+        self.source.timed_flush()
+
+        return r
+
+    def _close(self):
+        self.source._close()
+
+    def _create(self):
+        self.source._create()
+        self._reset()
+
+
+    # helping functions
+
+    def _reset(self):
+        """ drops all in-memory data """
+
+        with self.lock:
+            self.db = {
+                "topics":       {},
+                "stories":      {},
+                "users":        {},
+                "followers":    {},
+                "templates":    {},
+                "images":       {}
+            }
+
+            # lists of ids, by ("topics",), ("stories", topic_id),
+            # ("users",), ("followers", user_id), ("templates",), ("images",);
+            # and the story index, by ("index",), as story_set() tuples
+            self.ids = {}
+
+            self.gen       += 1
+            self.stamp      = self.source._stamp()
+            self.check_last = time.time()
+
+    def _check(self):
+        """ reloads everything if the source was modified externally """
+
+        t = time.time()
+
+        # None means someone else calls invalidate() (e.g. inotify)
+        if self.check_interval is None:
+            return
+
+        with self.lock:
+            if t - self.check_last <= self.check_interval:
+                return
+
+            self.check_last = t
+
+        stamp = self.source._stamp()
+
+        with self.lock:
+            if stamp is None or stamp != self.stamp:
+                self.log("DEBUG", "Cached: source modified, reloading")
+                self._reset()
+
+    def _write(self, method, *args):
+        """ calls a writing method of the source; as this modifies it,
+            the stamp is taken again (if nobody else modified it before) """
+
+        stamp = self.source._stamp()
+        ret   = method(*args)
+
+        with self.lock:
+            self.gen += 1
+
+            if stamp == self.stamp:
+                self.stamp = self.source._stamp()
+
+        return ret
+
+    def _copy(self, data):
+        """ returns a copy of an object's data """
+
+        if data is None:
+            return None
+
+        d = {}
+
+        for k, v in data.items():
+            d[k] = list(v) if isinstance(v, list) else v
+
+        return d
+
+    def _get(self, table, key, load, copy=None):
+        """ gets an object's data from memory, loading it if needed """
+
+        copy = copy or self._copy
+
+        self._check()
+
+        with self.lock:
+            gen = self.gen
+
+            if key in self.db[table]:
+                return copy(self.db[table][key])
+
+        # (loaded without the lock, as it can be slow)
+        data = load()
+
+        with self.lock:
+            if gen == self.gen:
+                self.db[table][key] = data
+
+        return copy(data)
+
+    def _ids(self, key, load):
+        """ gets a list of ids from memory, loading it if needed """
+
+        self._check()
+
+        with self.lock:
+            gen = self.gen
+            ids = self.ids.get(key)
+
+        if ids is None:
+            ids = list(load())
+
+            with self.lock:
+                if gen == self.gen:
+                    self.ids[key] = ids
+
+        # (lists are replaced, never modified)
+        return ids
+
+    def _data(self, o):
+        return self._copy(o.data) if o is not None else None
+
+    def _set(self, table, key, data, *ids):
+        """ stores an object's data after writing it, dropping lists of ids """
+
+        with self.lock:
+            self.gen += 1
+            self.db[table][key] = data
+
+            for k in ids:
+                self.ids.pop(k, None)
+
+    def _fill(self, o, data):
+        if data is None:
+            return None
+
+        o.data = data
+
+        return o
+
+    def _stamp(self):
+        return self.source._stamp()
+
+    def invalidate(self, what, id="", topic_id="", tags=None):
+        with self.lock:
+            self.gen += 1
+
+            if what == "story":
+                self.db["stories"].pop((topic_id, id), None)
+                self.ids.pop(("stories", topic_id), None)
+                self.ids.pop(("index",), None)
+
+            elif what == "index":
+                self.ids.pop(("index",), None)
+
+            elif what == "topic":
+                self.db["topics"].pop(id, None)
+                self.ids.pop(("topics",), None)
+                self.ids.pop(("stories", id), None)
+
+            elif what == "user":
+                self.db["users"].pop(id, None)
+                self.ids.pop(("users",), None)
+
+            elif what == "followers":
+                for k in [k for k in self.db["followers"] if k[0] == id]:
+                    del self.db["followers"][k]
+
+                self.ids.pop(("followers", id), None)
+
+            elif what == "template":
+                self.db["templates"].pop(id, None)
+                self.ids.pop(("templates",), None)
+
+            elif what == "image":
+                self.db["images"].pop(id, None)
+                self.ids.pop(("images",), None)
+
+        super().invalidate(what, id, topic_id, tags)
+
+
+    # TOPICS
+
+    def _load_topic(self, topic):
+        id = topic.get("id")
+
+        data = self._get("topics", id, lambda: self._data(self.source.topic(id)))
+
+        return self._fill(topic, data)
+
+    def _save_topic(self, topic):
+        topic = self._write(self.source._save_topic, topic)
+
+        if topic is not None:
+            self._set("topics", topic.get("id"), self._copy(topic.data), ("topics",))
+
+        return topic
+
+    def topics(self, private=False):
+        ids = self._ids(("topics",), lambda: self.source.topics(private=True))
+
+        for id in ids:
+            topic = self.topic(id)
+
+            if topic is not None and (private or topic.get("internal") != "1"):
+                yield id
+
+
+    # STORIES
+
+    def _load_story(self, story):
+        topic_id = story.get("topic_id")
+        id       = story.get("id")
+
+        data = self._get("stories", (topic_id, id),
+            lambda: self._data(self.source.story(topic_id, id)))
+
+        return self._fill(story, data)
+
+    def _save_story(self, story):
+        story = self._write(self.source._save_story, story)
+
+        if story is not None:
+            topic_id = story.get("topic_id")
+
+            self._set("stories", (topic_id, story.get("id")), self._copy(story.data),
+                ("stories", topic_id), ("index",))
+
+        return story
+
+    def _save_hits(self, stories):
+        self._write(self.source._save_hits, stories)
+
+        with self.lock:
+            for story in stories:
+                data = self.db["stories"].get((story.get("topic_id"), story.get("id")))
+
+                if data is not None:
+                    data["hits"] = story.get("hits")
+
+    def _delete_story(self, story):
+        topic_id = story.get("topic_id")
+
+        ret = self._write(self.source._delete_story, story)
+
+        self._set("stories", (topic_id, story.get("id")), None,
+            ("stories", topic_id), ("index",))
+
+        return ret
+
+    def stories(self, topic_id):
+        ids = self._ids(("stories", topic_id), lambda: self.source.stories(topic_id))
+
+        for id in ids:
+            yield id
+
+
+    # USERS
+
+    def _load_user(self, user):
+        id = user.get("id")
+
+        data = self._get("users", id, lambda: self._data(self.source.user(id)))
+
+        return self._fill(user, data)
+
+    def _save_user(self, user):
+        user = self._write(self.source._save_user, user)
+
+        if user is not None:
+            self._set("users", user.get("id"), self._copy(user.data), ("users",))
+
+        return user
+
+    def users(self, private=False):
+        ids = self._ids(("users",), lambda: self.source.users(private=True))
+
+        for id in ids:
+            user  = self.user(id)
+            xdate = user.get("xdate")
+
+            if private is True or xdate == "" or xdate > self.today():
+                yield id
+
+
+    # FOLLOWERS
+
+    def _load_follower(self, follower):
+        uid = follower.get("user_id")
+        id  = follower.get("id")
+
+        data = self._get("followers", (uid, id),
+            lambda: self._data(self.source.follower(uid, id)))
+
+        return self._fill(follower, data)
+
+    def _save_follower(self, follower):
+        uid = follower.get("user_id")
+
+        ret = self._write(self.source._save_follower, follower)
+
+        self._set("followers", (uid, follower.get("id")), self._copy(follower.data),
+            ("followers", uid))
+
+        return ret
+
+    def delete_follower(self, follower):
+        uid = follower.get("user_id")
+
+        self._write(self.source.delete_follower, follower)
+
+        self._set("followers", (uid, follower.get("id")), None, ("followers", uid))
+
+    def followers(self, user_id, network=None, active=False, ldate=None):
+        ids = self._ids(("followers", user_id), lambda: self.source.followers(user_id))
+
+        filtered = network is not None or active or ldate is not None
+
+        for id in ids:
+            if filtered:
+                f = self.follower(user_id, id)
+
+                if f is None or not self.follower_matches(f, network, active, ldate):
+                    continue
+
+            yield id
+
+
+    # TEMPLATES
+
+    def _template(self, id):
+        return self._get("templates", id, lambda: self.source.template(id),
+            lambda c: c)
+
+    def save_template(self, id, content):
+        ret = self._write(self.source.save_template, id, content)
+
+        self._set("templates", id, content, ("templates",))
+
+        return ret
+
+    def templates(self):
+        ids = self._ids(("templates",), self.source.templates)
+
+        for id in ids:
+            yield id
+
+
+    # IMAGES
+
+    def image(self, id):
+        return self._get("images", id, lambda: self.source.image(id), lambda c: c)
+
+    def image_file(self, id):
+        return self.source.image_file(id)
+
+    def save_image(self, id, content):
+        ok = self._write(self.source.save_image, id, content)
+
+        if ok:
+            self._set("images", id, content, ("images",))
+
+        return ok
+
+    def images(self):
+        ids = self._ids(("images",), self.source.images)
+
+        for id in ids:
+            yield id
+
+
+    # STORY SETS
+
+    def _story_set(self, topics=None, tags=None, content=None, order="date",
+                   d_from=None, d_to=None, num=None, offset=0, private=False,
+                   timeout=None):
+
+        # only the date index is kept in memory
+        if order != "date":
+            yield from self.source.story_set(topics=topics, tags=tags,
+                content=content, order=order, d_from=d_from, d_to=d_to,
+                num=num, offset=offset, private=private, timeout=timeout)
+            return
+
+        index = self._ids(("index",), lambda: self.source.story_set(private=True))
+
+        res = 0
+        cnt = 0
+
+        today = self.today()
+
+        if timeout is not None:
+            timeout += time.time()
+
+        for i in index:
+            # timeout?
+            if timeout is not None and time.time() > timeout:
+                break
+
+            # pick data
+            s_topic, s_id, s_date, s_tags, s_udate = i
+
+            # not on topic?
+            if topics is not None:
+                if not s_topic in topics:
+                    continue
+
+            # skip if date is above the threshold
+            if d_to is not None and s_date > d_to:
+                continue
+
+            # exit if date is below the threshold
+            if d_from is not None and s_date < d_from:
+                break
+
+            # were private stories not requested?
+            if not private:
+                # reject still unpublished stories
+                if s_date > today:
+                    continue
+
+                # reject un-published stories
+                if s_udate != "" and s_udate < today:
+                    continue
+
+                # reject stories from internal topics
+                t = self.topic(s_topic)
+
+                if t is None or t.get("internal") == "1":
+                        continue
+
+            if tags is not None:
+                if not self.is_subset_of(tags, s_tags):
+                    continue
+
+            # matching content?
+            if content is not None:
+                s = self.story(id=s_id, topic_id=s_topic)
+
+                if content.lower() not in s.get("content").lower():
+                    continue
+
+            # this story matches the desired set
+            cnt += 1
+
+            if cnt <= offset:
+                continue
+
+            # result!
+            yield s_topic, s_id, s_date, s_tags, s_udate
+
+            res += 1
+
+            # finish if we have all the stories we need
+            if num is not None and res == num:
+                break
@@ -7,7 +7,7 @@
 
 #   Gruta source FS
 
-import glob, os, hashlib, time, fcntl
+import glob, os, hashlib, time, fcntl, threading
 
 from pygruta.base import Gruta
 
@@ -16,34 +16,79 @@ class FS(Gruta):
     def __init__(self, path):
         self.path = path
 
+        # number of stories kept in topics/.top_ten
+        self.top_ten_max = 100
+
+        # durability: "none", "save" (fsync on every save)
+        # or "group" (fsync in batches)
+        self.sync = "none"
+        self.sync_pending   = set()
+        self.sync_group_max = 64
+        self.sync_group_age = 5
+        self.sync_last      = time.time()
+        self.sync_lock      = threading.Lock()
+
         # init the base class
         super().__init__()
 
+        self.sync = self.template("cfg_fs_sync") or "none"
+
+        # store new stories packed in a single file?
+        self.pack = self.template("cfg_fs_pack") == "1"
+
     def _flush(self):
-        pass
+        self._sync()
+
+    def timed_flush(self):
+        # don't leave the last written files unsynced for long
+        if self.sync == "group" and time.time() - self.sync_last > self.sync_group_age:
+            self._sync()
+
+        return super().timed_flush()
 
     def _close(self):
-        pass
+        self._sync()
 
     def id(self):
         return "FS (%s)" % self.path
 
+    def _stamp(self):
+        # newest mtime of the folders and their direct entries
+        # (story saves always replace topics/.INDEX)
+        stamp = 0
+
+        for d in ("topics", "users", "followers", "templates", "images"):
+            try:
+                for e in os.scandir("%s/%s" % (self.path, d)):
+                    stamp = max(stamp, e.stat().st_mtime_ns)
+
+                stamp = max(stamp, os.stat("%s/%s" % (self.path, d)).st_mtime_ns)
+            except:
+                pass
+
+        return stamp
+
 
     # helping functions
 
-    def _file_to_dict(self, file):
+    def _lines_to_dict(self, lines):
         o = {}
-    
+
+        for l in lines:
+            l = l.rstrip().split(": ", 1)
+            if len(l) == 2:
+                l[0] = l[0].replace("-", "_")
+                l[1] = l[1].replace("\\n", "\n")
+                o[l[0]] = l[1]
+
+        return o
+
+    def _file_to_dict(self, file):
         try:
             with open(file) as f:
                 fcntl.flock(f, 1)
 
-                for l in f:
-                    l = l.rstrip().split(": ", 1)
-                    if len(l) == 2:
-                        l[0] = l[0].replace("-", "_")
-                        l[1] = l[1].replace("\\n", "\n")
-                        o[l[0]] = l[1]
+                o = self._lines_to_dict(f)
         except:
             o = None
     
@@ -55,23 +100,77 @@ class FS(Gruta):
         except:
             return ""
     
-    def _dict_to_file(self, o, file, exclude=[]):
-        with open(file, "w") as f:
-            fcntl.flock(f, 2)
+    def _dict_to_string(self, o, exclude=[]):
+        s = ""
+
+        for k, v in o.items():
+            if k not in exclude:
+                if isinstance(v, list):
+                    v = ",".join(v)
 
-            for k, v in o.items():
-                if k not in exclude:
-                    if isinstance(v, list):
-                        v = ",".join(v)
+                v = v.replace("\n", "\\n")
 
-                    v = v.replace("\n", "\\n")
+                s += "%s: %s\n" % (k, v)
 
-                    f.write("%s: %s\n" % (k, v))
+        return s
+
+    def _dict_to_file(self, o, file, exclude=[]):
+        self._string_to_file(self._dict_to_string(o, exclude), file)
 
     def _string_to_file(self, s, file):
-        with open(file, "w") as f:
+        # write to a temporary file and rename it into place,
+        # so readers never see a half-written file
+        d, b = os.path.split(file)
+        tmp  = "%s/.%s.%d.%d.tmp" % (d, b, os.getpid(), threading.get_ident())
+
+        with open(tmp, "wb" if isinstance(s, bytes) else "w") as f:
             f.write(s)
 
+            if self.sync == "save":
+                f.flush()
+                os.fsync(f.fileno())
+
+        os.rename(tmp, file)
+
+        if self.sync == "group":
+            self._pending(file)
+
+    def _pending(self, file):
+        """ adds a file to the group commit, doing it if it's big or old enough """
+
+        with self.sync_lock:
+            self.sync_pending.add(file)
+
+            n = len(self.sync_pending)
+
+        if n >= self.sync_group_max or time.time() - self.sync_last > self.sync_group_age:
+            self._sync()
+
+    def _fsync(self, file):
+        try:
+            fd = os.open(file, os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+        except:
+            pass
+
+    def _sync(self):
+        """ fsyncs all files written since the last group commit """
+
+        with self.sync_lock:
+            pending, self.sync_pending = self.sync_pending, set()
+            self.sync_last = time.time()
+
+        folders = set()
+
+        for file in pending:
+            self._fsync(file)
+            folders.add(os.path.dirname(file))
+
+        # make the renames durable
+        for d in folders:
+            self._fsync(d)
+
 
 
     # create
@@ -132,21 +231,89 @@ class FS(Gruta):
 
     # STORIES
 
+    # A story is stored either as five files (id, id.M, id.B, id.A
+    # and id.H) or packed into a single id.P file. A packed file has
+    # a header line with the magic and the byte lengths of the metadata,
+    # content, body, abstract and hits sections, that follow it:
+    #
+    # GRUTA-PACK 180 1024 1000 300 2\n<metadata><content>...
+    #
+    # Hits stored after a packed story is saved go to its id.H file
+    # (which, if it exists, is newer than the hits in the pack), so
+    # counting visits never rewrites the story.
+
+    def _pack(self, story):
+        """ returns a story as a packed file """
+
+        parts = [
+            self._dict_to_string(story.data, ["abstract", "body", "hits", "content"]),
+            story.get("content"),
+            story.get("body"),
+            story.get("abstract"),
+            story.get("hits")
+        ]
+
+        parts = [p.encode() for p in parts]
+
+        head = "GRUTA-PACK %s\n" % " ".join([str(len(p)) for p in parts])
+
+        return head.encode() + b"".join(parts)
+
+    def _unpack(self, file):
+        """ reads a packed file, returning its sections (or None) """
+
+        try:
+            with open(file, "rb") as f:
+                data = f.read()
+
+            head, data = data.split(b"\n", 1)
+            head = head.decode().split(" ")
+
+            if head[0] != "GRUTA-PACK":
+                raise ValueError(file)
+
+            parts, o = [], 0
+
+            for l in head[1:]:
+                l = int(l)
+                parts.append(data[o:o + l].decode())
+                o += l
+
+        except:
+            parts = None
+
+        return parts
+
     def _load_story(self, story):
         if story.get("id") != "":
             file = "%s/topics/%s/%s" % (
                 self.path, story.get("topic_id"), story.get("id")
             )
 
-            # get metadata
-            story = story.fill(self._file_to_dict(file + ".M"))
+            parts = self._unpack(file + ".P")
 
-            if story is not None:
-                story.set("content",  self._file_to_string(file))
-                story.set("body",     self._file_to_string(file + ".B"))
-                story.set("abstract", self._file_to_string(file + ".A"))
-                story.set("hits",     self._file_to_string(file + ".H"))
+            if parts is not None:
+                # packed story: one read
+                meta, content, body, abstract, hits = parts
 
+                story = story.fill(self._lines_to_dict(meta.split("\n")))
+
+                story.set("content",  content)
+                story.set("body",     body)
+                story.set("abstract", abstract)
+                story.set("hits",     self._file_to_string(file + ".H") or hits)
+
+            else:
+                # get metadata
+                story = story.fill(self._file_to_dict(file + ".M"))
+
+                if story is not None:
+                    story.set("content",  self._file_to_string(file))
+                    story.set("body",     self._file_to_string(file + ".B"))
+                    story.set("abstract", self._file_to_string(file + ".A"))
+                    story.set("hits",     self._file_to_string(file + ".H"))
+
+            if story is not None:
                 tags = story.get("tags").replace(", ", ",")
                 if tags:
                     tags = tags.split(",")
@@ -206,6 +373,14 @@ class FS(Gruta):
             if r is not None:
                 ni.write(r)
 
+            if self.sync == "save":
+                ni.flush()
+                os.fsync(ni.fileno())
+
+            # close before swapping, so readers see it complete
+            oi.close()
+            ni.close()
+
             # now swap
             try:
                 os.unlink(index + ".old")
@@ -215,9 +390,8 @@ class FS(Gruta):
             os.link(index,            index + ".old")
             os.rename(index + ".new", index)
 
-            # finally close and release lock
-            oi.close()
-            ni.close()
+            if self.sync == "group":
+                self._pending(index)
 
         else:
             # no index; create it
@@ -248,21 +422,129 @@ class FS(Gruta):
         lk.close()
 
 
-    def _save_story(self, story):
-        """ saves a story """
+    def _write_story(self, story):
+        """ writes the story files """
         file = "%s/topics/%s/%s" % (self.path, story.get("topic_id"), story.get("id"))
 
-        self._dict_to_file(story.data, file + ".M", ["abstract", "body", "hits", "content"])
-        self._string_to_file(story.get("content"),  file)
-        self._string_to_file(story.get("body"),     file + ".B")
-        self._string_to_file(story.get("abstract"), file + ".A")
-        self._string_to_file(story.get("hits"),     file + ".H")
+        if self.pack:
+            self._string_to_file(self._pack(story), file + ".P")
+
+            # delete the unpacked files, if any
+            exts = ["", ".M", ".B", ".A", ".H"]
+
+        else:
+            self._dict_to_file(story.data, file + ".M", ["abstract", "body", "hits", "content"])
+            self._string_to_file(story.get("content"),  file)
+            self._string_to_file(story.get("body"),     file + ".B")
+            self._string_to_file(story.get("abstract"), file + ".A")
+            self._string_to_file(story.get("hits"),     file + ".H")
+
+            # delete the packed file, if any
+            exts = [".P"]
+
+        for ext in exts:
+            try:
+                os.unlink(file + ext)
+            except:
+                pass
+
+        return file
+
+
+    def _save_story(self, story):
+        """ saves a story """
+        file = self._write_story(story)
 
         self._update_index(story)
 
+        if self.sync == "save":
+            self._fsync(os.path.dirname(file))
+            self._fsync(self.path + "/topics")
+
         return story
 
 
+    def _save_hits(self, stories):
+        """ saves the hits of a batch of stories """
+
+        for story in stories:
+            file = "%s/topics/%s/%s" % (self.path, story.get("topic_id"), story.get("id"))
+
+            # (also for packed stories; see above)
+            self._string_to_file(story.get("hits"), file + ".H")
+
+        self._update_top_ten(stories)
+
+
+    def _update_top_ten(self, stories, delete=False):
+        """ merges stories into the most visited index """
+
+        index = "%s/topics/.top_ten" % self.path
+
+        lk = open(index + ".lck", "w")
+        fcntl.flock(lk, 2)
+
+        # current entries, as (hits, record)
+        top = {}
+
+        try:
+            with open(index) as oi:
+                for l in oi:
+                    tr = l.replace("\n", "").split(":")
+
+                    if len(tr) < 3:
+                        continue
+
+                    file = "%s/topics/%s/%s" % (self.path, tr[1], tr[2])
+                    hits = self._file_to_string(file + ".H")
+
+                    if hits == "":
+                        parts = self._unpack(file + ".P")
+
+                        if parts is not None:
+                            hits = parts[4]
+
+                    try:
+                        hits = int(hits.strip() or "0")
+                    except:
+                        hits = 0
+
+                    top[(tr[1], tr[2])] = (hits, l)
+        except:
+            pass
+
+        for story in stories:
+            k = (story.get("topic_id"), story.get("id"))
+
+            if delete:
+                top.pop(k, None)
+            else:
+                try:
+                    hits = int(story.get("hits") or "0")
+                except:
+                    hits = 0
+
+                r = ":".join([
+                    story.get("date"),
+                    k[0],
+                    k[1],
+                    ",".join(story.get("tags")),
+                    story.get("udate")
+                    ]) + "\n"
+
+                top[k] = (hits, r)
+
+        l = sorted(top.values(), key=lambda e: e[0], reverse=True)
+
+        with open(index + ".new", "w") as ni:
+            for hits, r in l[0:self.top_ten_max]:
+                ni.write(r)
+
+        os.rename(index + ".new", index)
+
+        lk.close()
+
+
     def _delete_story(self, story):
         """ deletes a story """
         file = "%s/topics/%s/%s" % (self.path, story.get("topic_id"), story.get("id"))
@@ -270,8 +552,11 @@ class FS(Gruta):
         # de-index
         self._update_index(story, delete=True)
 
+        if os.path.exists("%s/topics/.top_ten" % self.path):
+            self._update_top_ten([story], delete=True)
+
         # delete all files
-        for ext in ["", ".M", ".B", ".A", ".H"]:
+        for ext in ["", ".M", ".B", ".A", ".H", ".P"]:
             try:
                 os.unlink(file + ext)
             except:
@@ -284,10 +569,35 @@ class FS(Gruta):
         if self.topic(topic_id) is None:
             raise KeyError("topic_id")
 
-        for id in glob.glob("%s/topics/%s/*.M" % (self.path, topic_id)):
-            id = os.path.basename(id).replace(".M", "")
+        ids = set()
+
+        # unpacked (.M) and packed (.P) stories
+        for id in glob.glob("%s/topics/%s/*.[MP]" % (self.path, topic_id)):
+            id = os.path.basename(id)[0:-2]
+
+            if id not in ids:
+                ids.add(id)
+                yield(id)
+
+
+    def pack_stories(self, pack=True):
+        """ converts all stories to the packed (or unpacked) format """
+
+        self.pack = pack
 
-            yield(id)
+        for topic_id in self.topics(private=True):
+            for id in list(self.stories(topic_id)):
+                story = self.story(topic_id, id)
+
+                if story is not None:
+                    self.log("DEBUG", "Pack: story '%s/%s'" % (topic_id, id))
+
+                    # the index does not change
+                    self._write_story(story)
+
+        self._sync()
+
+        self.save_template("cfg_fs_pack", "1" if pack else "0")
 
 
     # USERS
@@ -323,11 +633,108 @@ class FS(Gruta):
 
         return follower.fill(self._file_to_dict(file))
 
-    def followers(self, user_id):
-        for f in glob.glob("%s/followers/%s/*" % (self.path, user_id)):
-            d = self._file_to_dict(f)
+    # Each user has a followers/<uid>/.INDEX manifest, an append-only log
+    # of lines with the summary of saved (+) or deleted (-) followers:
+    #
+    # +:network:disabled:failures:ldate:id
+
+    def _read_followers_index(self, index, user_id):
+        """ reads a followers manifest, returning a dict of id -> Follower
+            and its number of lines (None if it doesn't exist) """
+
+        fs = {}
+        n  = 0
+
+        try:
+            with open(index) as f:
+                for l in f:
+                    l = l.rstrip("\n").split(":", 5)
+                    n += 1
+
+                    if len(l) != 6:
+                        continue
+
+                    if l[0] == "-":
+                        fs.pop(l[5], None)
+                    else:
+                        fs[l[5]] = self.new_follower({
+                            "id":       l[5],
+                            "user_id":  user_id,
+                            "network":  l[1],
+                            "disabled": l[2],
+                            "failures": l[3],
+                            "ldate":    l[4]
+                        })
+
+        except FileNotFoundError:
+            n = None
+
+        return fs, n
+
+    def _followers_index(self, user_id):
+        """ reads the followers manifest, as a dict of id -> Follower """
+
+        folder = "%s/followers/%s" % (self.path, user_id)
+        index  = folder + "/.INDEX"
+
+        fs, n = self._read_followers_index(index, user_id)
+
+        if n is None and not os.path.isdir(folder):
+            return fs
+
+        # missing or too many stale lines? (re)write it
+        if n is None or n > 2 * len(fs) + 32:
+            lk = open(index + ".lck", "w")
+            fcntl.flock(lk, 2)
+
+            # read it again, as others may have logged changes meanwhile
+            fs, n = self._read_followers_index(index, user_id)
+
+            if n is None:
+                # no manifest yet: build it from the follower files
+                # (changes wait for the lock to be logged into it)
+                for file in glob.glob(folder + "/*"):
+                    d = self._file_to_dict(file)
+
+                    if d is not None and d.get("id"):
+                        fs[d["id"]] = self.new_follower(d)
 
-            yield d["id"]
+            if n is None or n > 2 * len(fs) + 32:
+                self._string_to_file("".join([
+                    self._follower_line("+", f) for f in fs.values()]), index)
+
+            lk.close()
+
+        return fs
+
+    def _follower_line(self, op, follower):
+        return ":".join([op,
+            follower.get("network"),
+            follower.get("disabled"),
+            follower.get("failures"),
+            follower.get("ldate"),
+            follower.get("id")
+            ]) + "\n"
+
+    def _follower_log(self, op, follower):
+        """ appends a change to the followers manifest """
+
+        index = "%s/followers/%s/.INDEX" % (self.path, follower.get("user_id"))
+
+        lk = open(index + ".lck", "w")
+        fcntl.flock(lk, 2)
+
+        # if it doesn't exist, it will be built from the files
+        if os.path.exists(index):
+            with open(index, "a") as f:
+                f.write(self._follower_line(op, follower))
+
+        lk.close()
+
+    def followers(self, user_id, network=None, active=False, ldate=None):
+        for id, f in self._followers_index(user_id).items():
+            if self.follower_matches(f, network, active, ldate):
+                yield id
 
     def _save_follower(self, follower):
         folder = "%s/followers/%s" % (self.path, follower.get("user_id"))
@@ -341,6 +748,8 @@ class FS(Gruta):
 
         self._dict_to_file(follower.data, file)
 
+        self._follower_log("+", follower)
+
     def delete_follower(self, follower):
         file = "%s/followers/%s/%s" % (
             self.path, follower.get("user_id"), self.md5(follower.get("id")))
@@ -350,10 +759,12 @@ class FS(Gruta):
         except:
             pass
 
+        self._follower_log("-", follower)
+
 
     # TEMPLATES
 
-    def template(self, id):
+    def _template(self, id):
         return self._file_to_string("%s/templates/%s" % (self.path, id))
 
     def save_template(self, id, content):
@@ -383,6 +794,17 @@ class FS(Gruta):
 
         return content
 
+    def image_file(self, id):
+        fn = None
+
+        if self.valid_image_id(id) and id[0] != ".":
+            fn = "%s/images/%s" % (self.path, id)
+
+            if not os.path.isfile(fn):
+                fn = None
+
+        return fn
+
     def save_image(self, id, content):
         ok = False
 
@@ -390,9 +812,11 @@ class FS(Gruta):
             fn = "%s/images/%s" % (self.path, id)
 
             try:
-                f = open(fn, "wb")
-                f.write(content)
-                f.close()
+                self._string_to_file(content, fn)
+
+                if self.sync == "save":
+                    self._fsync(os.path.dirname(fn))
+
                 ok = True
             except:
                 pass
@@ -408,9 +832,9 @@ class FS(Gruta):
 
     # STORY SETS
 
-    def story_set(self, topics=None, tags=None, content=None, order="date",
-                  d_from=None, d_to=None, num=None, offset=0, private=False,
-                  timeout=None):
+    def _story_set(self, topics=None, tags=None, content=None, order="date",
+                   d_from=None, d_to=None, num=None, offset=0, private=False,
+                   timeout=None):
         res = 0
         cnt = 0
 
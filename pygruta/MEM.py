@@ -7,7 +7,7 @@
 
 #   Gruta source MEM
 
-import json, time, base64
+import json, time, base64, os
 from pygruta.base import Gruta
 
 class MEM(Gruta):
@@ -53,6 +53,12 @@ class MEM(Gruta):
     def _create(self):
         pass
 
+    def _stamp(self):
+        try:
+            return os.stat(self.file).st_mtime_ns
+        except:
+            return 0
+
 
     # TOPICS
 
@@ -141,6 +147,15 @@ class MEM(Gruta):
 
         self.db[".INDEX"] = I
 
+    def _save_hits(self, stories):
+        for story in stories:
+            data = self.db["stories"].get(story.get("topic_id"), {}).get(story.get("id"))
+
+            if data is not None:
+                data["hits"] = story.get("hits")
+
+        self.mod += 1
+
     def _delete_story(self, story):
         k = story.get("topic_id") + "/" + story.get("id")
         del self.db["stories"][k]
@@ -224,16 +239,17 @@ class MEM(Gruta):
 
         return None
 
-    def followers(self, user_id):
+    def followers(self, user_id, network=None, active=False, ldate=None):
         if self.db["followers"].get(user_id) is not None:
-            for id in self.db["followers"][user_id]:
-                yield id
+            for id, data in self.db["followers"][user_id].items():
+                if self.follower_matches(self.new_follower(data), network, active, ldate):
+                    yield id
 
 
 
     # TEMPLATES
 
-    def template(self, id):
+    def _template(self, id):
         return self.db["templates"].get(id) or ""
 
     def save_template(self, id, content):
@@ -279,9 +295,9 @@ class MEM(Gruta):
 
     # STORY SETS
 
-    def story_set(self, topics=None, tags=None, content=None, order="date",
-                  d_from=None, d_to=None, num=None, offset=0, private=False,
-                  timeout=None):
+    def _story_set(self, topics=None, tags=None, content=None, order="date",
+                   d_from=None, d_to=None, num=None, offset=0, private=False,
+                   timeout=None):
         res = 0
         cnt = 0
 
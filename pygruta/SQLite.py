@@ -7,25 +7,71 @@
 
 #   Gruta source SQLite
 
-import base64
+import base64, os, threading, inspect
 import sqlite3
 
 from pygruta.base import Gruta
 
 
+def locked(method):
+    """ serializes the use of the connection among threads """
+
+    if inspect.isgeneratorfunction(method):
+        # read all rows while locked
+        def f(self, *args, **kwargs):
+            with self.lock:
+                rows = list(method(self, *args, **kwargs))
+
+            yield from rows
+    else:
+        def f(self, *args, **kwargs):
+            with self.lock:
+                return method(self, *args, **kwargs)
+
+    return f
+
+
 class SQLite(Gruta):
     def __init__(self, path):
         self.path = path
 
-        self.db = sqlite3.connect(self.path)
+        # one connection shared by all threads (writes are committed
+        # on flush, so per-thread ones wouldn't see each other's)
+        self.db   = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.RLock()
 
         # init the base class
         super().__init__()
 
+        self._upgrade()
+
+    @locked
+    def _upgrade(self):
+        """ adds the columns for fields that are newer than the database """
+
+        cur = self.db.cursor()
+        mod = False
+
+        for table, o in (("topics", self.new_topic()), ("stories", self.new_story()),
+                         ("users", self.new_user()), ("followers", self.new_follower())):
+
+            cols = [r[1] for r in cur.execute("PRAGMA table_info(%s)" % table)]
+
+            # (no columns: not created yet)
+            for f in o.fields if len(cols) else []:
+                if f not in cols:
+                    cur.execute("ALTER TABLE %s ADD COLUMN %s" % (table, f))
+                    mod = True
+
+        if mod:
+            self.db.commit()
+
+    @locked
     def _flush(self):
 
         self.db.commit()
 
+    @locked
     def _close(self):
 
         self.db.commit()
@@ -34,7 +80,19 @@ class SQLite(Gruta):
     def id(self):
         return "SQLite (%s)" % self.path
 
+    def _stamp(self):
+        stamp = []
 
+        for f in (self.path, self.path + "-wal"):
+            try:
+                stamp.append(os.stat(f).st_mtime_ns)
+            except:
+                stamp.append(0)
+
+        return tuple(stamp)
+
+
+    @locked
     def _load_object(self, table, object, cond, tup):
         # generic object loading
         cur = self.db.cursor()
@@ -63,6 +121,7 @@ class SQLite(Gruta):
         return res
 
 
+    @locked
     def _save_object(self, table, object, data=None):
         # generic object insertion into table
         cur = self.db.cursor()
@@ -103,6 +162,7 @@ class SQLite(Gruta):
 
         return self._save_object("topics", topic)
 
+    @locked
     def topics(self, private=False):
 
         cur = self.db.cursor()
@@ -128,6 +188,7 @@ class SQLite(Gruta):
 
         return ret
 
+    @locked
     def _save_story(self, story):
 
         # create a copy of the data
@@ -158,6 +219,16 @@ class SQLite(Gruta):
 
         return ret
 
+    @locked
+    def _save_hits(self, stories):
+
+        cur = self.db.cursor()
+        sql = "UPDATE stories SET hits = ? WHERE topic_id = ? AND id = ?"
+
+        cur.executemany(sql, [
+            (s.get("hits"), s.get("topic_id"), s.get("id")) for s in stories])
+
+    @locked
     def _delete_story(self, story):
 
         cur = self.db.cursor()
@@ -167,6 +238,7 @@ class SQLite(Gruta):
 
         return None
 
+    @locked
     def stories(self, topic_id):
 
         cur = self.db.cursor()
@@ -186,6 +258,7 @@ class SQLite(Gruta):
 
         return self._save_object("users", user)
 
+    @locked
     def users(self, private=False):
 
         cur = self.db.cursor()
@@ -206,21 +279,36 @@ class SQLite(Gruta):
 
     def _load_follower(self, follower):
 
-        return self._load_object("followers", follower, "id = ?", [id])
+        return self._load_object("followers", follower, "user_id = ? AND id = ?",
+            [follower.get("user_id"), follower.get("id")])
 
     def _save_follower(self, follower):
 
         return self._save_object("followers", follower)
         pass
 
-    def followers(self, user_id):
+    @locked
+    def followers(self, user_id, network=None, active=False, ldate=None):
 
-        cur = self.db.cursor()
-        sql = "SELECT id FROM followers WHERE user_id = ?"
+        cur  = self.db.cursor()
+        sql  = "SELECT id FROM followers WHERE user_id = ?"
+        args = [user_id]
+
+        if network is not None:
+            sql += " AND network = ?"
+            args.append(network)
 
-        for line in cur.execute(sql, [user_id]):
+        if active:
+            sql += " AND disabled != '1'"
+
+        if ldate is not None:
+            sql += " AND ldate < ?"
+            args.append(ldate)
+
+        for line in cur.execute(sql, args):
             yield line[0]
 
+    @locked
     def delete_follower(self, follower):
 
         cur = self.db.cursor()
@@ -232,7 +320,8 @@ class SQLite(Gruta):
 
     # TEMPLATES
 
-    def template(self, id):
+    @locked
+    def _template(self, id):
 
         cur = self.db.cursor()
         sql = "SELECT content FROM templates where id = ?";
@@ -246,6 +335,7 @@ class SQLite(Gruta):
         return content
 
 
+    @locked
     def save_template(self, id, content):
 
         cur = self.db.cursor()
@@ -253,6 +343,7 @@ class SQLite(Gruta):
         cur.execute(sql, (id, content))
 
 
+    @locked
     def templates(self):
 
         cur = self.db.cursor()
@@ -264,6 +355,7 @@ class SQLite(Gruta):
 
     # IMAGES
 
+    @locked
     def image(self, id):
 
         cur = self.db.cursor()
@@ -281,6 +373,7 @@ class SQLite(Gruta):
         return content
 
 
+    @locked
     def save_image(self, id, content):
 
         ok = False
@@ -294,6 +387,7 @@ class SQLite(Gruta):
             cur.execute(sql, (id, content))
 
 
+    @locked
     def images(self):
 
         cur = self.db.cursor()
@@ -305,6 +399,7 @@ class SQLite(Gruta):
 
     # create
 
+    @locked
     def _create(self):
 
         cur = self.db.cursor()
@@ -340,9 +435,10 @@ class SQLite(Gruta):
 
     # STORY SET
 
-    def story_set(self, topics=None, tags=None, content=None, order="date",
-                  d_from=None, d_to=None, num=None, offset=0, private=False,
-                  timeout=None):
+    @locked
+    def _story_set(self, topics=None, tags=None, content=None, order="date",
+                   d_from=None, d_to=None, num=None, offset=0, private=False,
+                   timeout=None):
 
         cond  = []
         args  = []
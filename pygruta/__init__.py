@@ -8,6 +8,8 @@
 import time, re, os
 import unicodedata
 
+import pygruta.metrics
+
 __version__ = "1.49"
 
 def log_str(category, string):
@@ -20,7 +22,12 @@ def log(category, string):
 def open(source):
     """ opens a source driver """
 
-    if re.search("\.json$", source):
+    if source.startswith("cached:"):
+        # in-memory copy of another source
+        import pygruta.Cached
+        return pygruta.Cached.Cached(open(source[7:]))
+
+    elif re.search("\.json$", source):
         # it's a JSON-backed DB: return MEM
         import pygruta.MEM
         return pygruta.MEM.MEM(source)
@@ -41,6 +48,22 @@ def open(source):
 def special_uris(gruta, s, e=0, absolute=False):
     """ Processes the special URIs """
 
+    # only the outermost call is measured
+    if getattr(gruta.local, "in_special_uris", False):
+        return _special_uris(gruta, s, e, absolute)
+
+    gruta.local.in_special_uris = True
+    t = time.perf_counter()
+
+    try:
+        return _special_uris(gruta, s, e, absolute)
+    finally:
+        gruta.local.in_special_uris = False
+        pygruta.metrics.observe("pygruta_special_uris_seconds", time.perf_counter() - t)
+
+
+def _special_uris(gruta, s, e=0, absolute=False):
+
     regexes = [
         r'(story)://([\w0-9_-]+)/([\w0-9_-]+)\s*\(([^\)]+)\)',
         r'(story)://([\w0-9_-]+)/([\w0-9_-]+)',
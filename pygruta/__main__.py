@@ -43,6 +43,7 @@ def usage():
     print("activitypub-like {src} {uid} {post}        Likes a post")
     print("activitypub-send-story {src} \\             Sends a story as an ActivityPub note")
     print("    {actor_url} {topic_id} {id}")
+    print("activitypub-bench-sign {src} {uid}         Measures HTTP Signatures per second")
     print("search {src} 'query string'                Searches stories by content")
     print("icalendar-import {src} {file.ics}          Imports an iCalendar into 'events' topic")
     print("icalendar-export {src}                     Exports the 'events' topic as an iCalendar")
@@ -51,6 +52,11 @@ def usage():
     print("feeds {src}                                Sends all feeds")
     print("short-url {src} {url}                      Returns a shortened URL")
     print("gemini-snapshot {src} {outdir} [url_prfx]  Creates a Gemini snapshot")
+    print("pack {src} [-u]                            Packs FS stories into single files")
+    print("                                           (or unpacks them if -u)")
+
+    print("\nA {src} prefixed by 'cached:' (e.g. cached:/var/www/site) is kept")
+    print("in memory, reading through to the real source.")
 
     return 1
 
@@ -296,6 +302,29 @@ def main():
                     pygruta.activitypub.send_note_to_actor(gruta, user_o, dest, note)
 
 
+        elif cmd == "activitypub-bench-sign":
+            import pygruta.activitypub
+
+            if len(args) < 1:
+                ret = usage()
+            else:
+                uid = args.pop()
+
+                user = pygruta.activitypub.get_user(gruta, uid)
+
+                if user is None:
+                    pygruta.log("ERROR", "bad user id: " + uid)
+                    ret = 10
+                else:
+                    threads = os.cpu_count() or 1
+
+                    one, many = pygruta.activitypub.sign_benchmark(gruta, user,
+                        threads=threads)
+
+                    print("1 thread: %.1f signatures/s" % one)
+                    print("%d threads: %.1f signatures/s" % (threads, many))
+
+
         elif cmd == "twitter-import":
             import pygruta.twitter
 
@@ -518,6 +547,16 @@ def main():
                 import pygruta.gemini
                 pygruta.gemini.snapshot(gruta, outdir, url_prefix)
 
+        elif cmd == "pack":
+
+            import pygruta.FS
+
+            if not isinstance(gruta, pygruta.FS.FS):
+                pygruta.log("ERROR", "pack only works on FS sources")
+                ret = 10
+            else:
+                gruta.pack_stories(not (len(args) and args.pop() == "-u"))
+
         else:
             pygruta.log("ERROR", "invalid command: " + cmd)
             ret = 2
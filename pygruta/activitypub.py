@@ -7,15 +7,21 @@
 
 #   ActivityPub support
 
-import time, json, re
+import time, json, re, os, threading, urllib.parse
+import concurrent.futures, collections
 import OpenSSL
 import base64
 import datetime
 import hashlib
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
 
 import pygruta
 import pygruta.html
+import pygruta.router
 import pygruta.http
+import pygruta.spool
+import pygruta.cache
 
 # functions
 
@@ -91,13 +97,101 @@ def get_actor(actor_url):
     return status, actor
 
 
+# the actor cache (None, not yet created)
+actor_cache = None
+actor_ttl   = 86400
+actor_lock  = threading.Lock()
 
-def send_to_inbox(gruta, user, inbox, msg):
-    """ sends an ActivityPub JSON object to an inbox """
+# what is kept of cached actors
+ACTOR_FIELDS = ("id", "type", "inbox", "outbox", "endpoints", "publicKey",
+                "preferredUsername", "name", "url")
 
-#    print("send to inbox")
+def _actors(gruta):
+    """ returns the actor cache: on disk, if cfg_activitypub_actor_cache
+        is set, or in memory otherwise """
 
-    body = json.dumps(msg)
+    global actor_cache, actor_ttl
+
+    with actor_lock:
+        if actor_cache is None:
+            try:
+                actor_ttl = int(gruta.template("cfg_activitypub_actor_ttl") or "86400")
+            except:
+                actor_ttl = 86400
+
+            path = gruta.template("cfg_activitypub_actor_cache")
+
+            if path != "":
+                actor_cache = pygruta.cache.SharedCache(path, ttl=actor_ttl,
+                    max_entries=10000)
+            else:
+                actor_cache = pygruta.cache.Cache(ttl=actor_ttl, max_entries=10000)
+
+    return actor_cache
+
+
+def cached_actor(gruta, actor_url, refresh=False):
+    """ gets an actor object from the actor cache, or fetches it
+        (also if refresh is set); only the ACTOR_FIELDS are kept,
+        plus 'fetched', the time it was fetched """
+
+    c = _actors(gruta)
+
+    if not refresh:
+        actor_o = c.get(actor_url)[0]
+
+        if actor_o is not None:
+            return 200, actor_o
+
+    status, actor_o = get_actor(actor_url)
+
+    if status == 200 and isinstance(actor_o, dict):
+        actor_o = dict([(k, actor_o[k]) for k in ACTOR_FIELDS if k in actor_o])
+        actor_o["fetched"] = time.time()
+
+        c.put(actor_url, actor_o, ttl=actor_ttl)
+    else:
+        # gone or broken: forget it
+        c.put(actor_url, None)
+        actor_o = None
+
+    return status, actor_o
+
+
+# PEM -> private key object
+keys      = {}
+keys_lock = threading.Lock()
+
+def private_key(user):
+    """ returns the private key object of a user (loaded only once) """
+
+    pem = user.get("privkey")
+
+    with keys_lock:
+        pk = keys.get(pem)
+
+        if pk is None:
+            pk = OpenSSL.crypto.load_privatekey(
+                OpenSSL.crypto.FILETYPE_PEM, pem).to_cryptography_key()
+
+            keys[pem] = pk
+
+    return pk
+
+
+def payload(msg):
+    """ serializes an object to be sent, returning the body and its
+        digest (to be reused when sending it to many inboxes) """
+
+    body = json.dumps(msg).encode()
+
+    digest = "SHA-256=" + base64.b64encode(hashlib.sha256(body).digest()).decode()
+
+    return body, digest
+
+
+def signature(gruta, user, inbox, digest, date):
+    """ builds the Signature header of a POST to an inbox """
 
     # calculate signature parts
     s = re.sub("^https://", "", inbox)
@@ -105,13 +199,6 @@ def send_to_inbox(gruta, user, inbox, msg):
 
     target = "post /" + target
 
-    date = datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
-
-    # digest
-    m = hashlib.sha256()
-    m.update(body.encode())
-    digest = "SHA-256=" + base64.b64encode(m.digest()).decode()
-
     # string to be signed
     s  = "(request-target): " + target + "\n"
     s += "host: " + host + "\n"
@@ -120,11 +207,7 @@ def send_to_inbox(gruta, user, inbox, msg):
 
     gruta.log("DEBUG", "ActivityPub: string to be signed '%s'" % s)
 
-    # build a key object
-    pk = OpenSSL.crypto.load_privatekey(
-        OpenSSL.crypto.FILETYPE_PEM, user.get("privkey"))
-
-    b = OpenSSL.crypto.sign(pk, s, "sha256")
+    b = private_key(user).sign(s.encode(), padding.PKCS1v15(), hashes.SHA256())
     sig_b64 = base64.b64encode(b).decode()
 
     # build the signature header
@@ -137,11 +220,57 @@ def send_to_inbox(gruta, user, inbox, msg):
 
     gruta.log("DEBUG", "ActivityPub: signature '%s'" % signature)
 
+    return signature
+
+
+def sign_benchmark(gruta, user, seconds=3, threads=None):
+    """ measures the signatures per second that can be made in one
+        thread (i.e. per core) and in many (one per CPU by default) """
+
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    body, digest = payload({"type": "Note", "content": "benchmark"})
+    date = datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+    # load the key out of the measure
+    private_key(user)
+
+    def run(n=0):
+        t = time.perf_counter() + seconds
+
+        while time.perf_counter() < t:
+            signature(gruta, user, "https://example.com/inbox", digest, date)
+            n += 1
+
+        return n
+
+    one = run() / seconds
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        many = sum(pool.map(run, [0] * threads)) / seconds
+
+    return one, many
+
+
+def send_to_inbox(gruta, user, inbox, msg, body=None):
+    """ sends an ActivityPub JSON object to an inbox
+        (body can be the already built payload() of msg) """
+
+    if body is None:
+        body = payload(msg)
+
+    body, digest = body
+
+    date = datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+    sig = signature(gruta, user, inbox, digest, date)
+
     # send the POST
     status, data = pygruta.http.request("POST", inbox, headers={
         "Content-Type":     "application/activity+json",
         "Date":             date,
-        "Signature":        signature,
+        "Signature":        sig,
         "Digest":           digest
         }, body=body)
 
@@ -164,10 +293,19 @@ def send_to_inbox(gruta, user, inbox, msg):
 def send_to_actor(gruta, user, actor_url, msg):
     """ sends an ActivityPub JSON object to an actor """
 
-    status, actor_o = get_actor(actor_url)
+    status, actor_o = cached_actor(gruta, actor_url)
 
     if status < 400 and actor_o is not None:
-        status, data = send_to_inbox(gruta, user, actor_o["inbox"], msg)
+        body = payload(msg)
+
+        status, data = send_to_inbox(gruta, user, actor_o["inbox"], msg, body)
+
+        if status < 200 or status > 299:
+            # the cached inbox may be outdated: if it changed, try again
+            s, new_o = cached_actor(gruta, actor_url, refresh=True)
+
+            if new_o is not None and new_o.get("inbox") != actor_o["inbox"]:
+                status, data = send_to_inbox(gruta, user, new_o["inbox"], msg, body)
     else:
         data = None
 
@@ -316,8 +454,8 @@ def note_from_story(gruta, story):
     return n
 
 
-def send_note_to_actor(gruta, user, dest, note):
-    """ Sends a Note (wrapping it in a Create object) and sends to dest """
+def create(gruta, user, note, to, cc=[]):
+    """ Wraps a Note in a Create object """
 
     # create object, date now
     date = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -328,8 +466,8 @@ def send_note_to_actor(gruta, user, dest, note):
     # create the "Create" object
     c = {
         "type":         "Create",
-        "to":           [dest],
-        "cc":           [],
+        "to":           to,
+        "cc":           cc,
         "actor":        src,
         "object":       note,
         "id":           note["url"] + "#pygruta-create",
@@ -339,7 +477,43 @@ def send_note_to_actor(gruta, user, dest, note):
         ]
     }
 
-    return send_to_actor(gruta, user, dest, c)
+    return c
+
+
+def send_note_to_actor(gruta, user, dest, note):
+    """ Sends a Note (wrapping it in a Create object) and sends to dest """
+
+    return send_to_actor(gruta, user, dest, create(gruta, user, note, [dest]))
+
+
+def set_inboxes(gruta, follower, actor_o):
+    """ stores the inbox and shared inbox of a follower's actor
+        (without saving it) """
+
+    try:
+        shared_inbox = actor_o["endpoints"]["sharedInbox"]
+    except:
+        shared_inbox = ""
+
+    follower.set("inbox",        actor_o.get("inbox") or "")
+    follower.set("shared_inbox", shared_inbox)
+    follower.set("adate",        gruta.today())
+
+
+def resolve_follower(gruta, follower):
+    """ fetches the inboxes of a follower's actor; returns the HTTP status
+        (a failure one if there is no inbox to deliver to) """
+
+    status, actor_o = cached_actor(gruta, follower.get("id"), refresh=True)
+
+    if status < 400 and actor_o is not None:
+        set_inboxes(gruta, follower, actor_o)
+
+    # an actor without an inbox cannot get anything
+    if status < 400 and follower.get("inbox") == "":
+        status = 404
+
+    return status
 
 
 
@@ -389,175 +563,361 @@ def react(gruta, user, url, type="Like"):
     return status, body
 
 
+class Delivery:
+    """ sends ActivityPub objects from a pool of threads, no more than
+        per_host at a time to the same host (the rest wait in line
+        without taking a thread) """
+
+    def __init__(self, workers=16, per_host=2):
+        self.pool     = concurrent.futures.ThreadPoolExecutor(workers)
+        self.per_host = per_host
+        self.lock     = threading.Lock()
+
+        # host -> deliveries in progress
+        self.active   = {}
+
+        # host -> deliveries waiting for their turn
+        self.waiting  = {}
+
+    def submit(self, url, fn, *args):
+        """ calls fn(*args) to deliver to url; returns a Future """
+
+        host = urllib.parse.urlsplit(url).netloc
+        f    = concurrent.futures.Future()
+
+        with self.lock:
+            if self.active.get(host, 0) < self.per_host:
+                self.active[host] = self.active.get(host, 0) + 1
+                self.pool.submit(self._task, host, f, fn, args)
+            else:
+                self.waiting.setdefault(host, collections.deque()).append(
+                    (f, fn, args))
+
+        return f
+
+    def _task(self, host, f, fn, args):
+        try:
+            f.set_result(fn(*args))
+
+        except Exception as e:
+            f.set_exception(e)
+
+        finally:
+            with self.lock:
+                q = self.waiting.get(host)
+
+                if q:
+                    # next one for the same host
+                    self.pool.submit(self._task, host, *q.popleft())
+
+                    if len(q) == 0:
+                        del self.waiting[host]
+                else:
+                    self.active[host] -= 1
+
+                    if self.active[host] == 0:
+                        del self.active[host]
+
+    def close(self):
+        self.pool.shutdown()
+
+
 def send_feed(gruta):
     """ Sends a blog feed to all followers """
 
-    for s in reversed(list(gruta.feed())):
+    try:
+        workers  = int(gruta.template("cfg_activitypub_delivery_workers") or "16")
+        per_host = int(gruta.template("cfg_activitypub_host_limit") or "2")
+    except:
+        workers, per_host = 16, 2
+
+    delivery = Delivery(workers, per_host)
+
+    try:
+        for s in reversed(list(gruta.feed())):
+            _send_story(gruta, delivery, s[0], s[1])
+    finally:
+        delivery.close()
+
 
-        # get start time for this story
-        t = time.time()
+def _send_story(gruta, delivery, topic_id, id):
+    """ sends a story to all followers of its author that haven't got it """
 
-        story = gruta.story(s[0], s[1])
+    story = gruta.story(topic_id, id)
 
-        # build a note
-        note = note_from_story(gruta, story)
+    # build a note
+    note = note_from_story(gruta, story)
 
-        cnt = 0
+    # get story author
+    uid = story.get("userid")
+    user = get_user(gruta, uid)
+
+    # the active followers of this user
+    # that had seen only older stories
+    followers = []
+
+    for fid in list(gruta.followers(uid, network="activitypub", active=True,
+                                    ldate=story.get("date"))):
 
-        # get story author
-        uid = story.get("userid")
-        user = get_user(gruta, uid)
+        follower = gruta.follower(uid, fid)
 
-        # iterate the followers of this user
-        for fid in gruta.followers(uid):
+        if follower is not None:
+            followers.append(follower)
 
-            follower = gruta.follower(uid, fid)
+    # get the inboxes of those that don't have them yet
+    # (or got them too long ago)
+    _actors(gruta)
+    adate = gruta.datetime_to_date(
+        datetime.datetime.now() - datetime.timedelta(seconds=actor_ttl))
 
-            if follower.get("network") == "activitypub" and follower.get("disabled") != "1":
+    jobs = {}
 
-                # had this follower seen only older stories?
-                if follower.get("ldate") < story.get("date"):
-                    status, body = send_note_to_actor(gruta, user, fid, note)
+    for follower in followers:
+        if follower.get("inbox") == "" or follower.get("adate") < adate:
+            follower.set("inbox", "")
 
-                    if status >= 200 and status <= 299:
-                        # follower received the story
-                        failures = 0
-                        follower.set("ldate", story.get("date"))
-                    else:
-                        # account one more failure
-                        failures = int(follower.get("failures") or "0") + 1
+            f = delivery.submit(follower.get("id"), resolve_follower, gruta, follower)
+            jobs[f] = follower
 
-                        try:
-                            body = body.decode()
-                        except:
-                            body = str(body)
+    for f in concurrent.futures.as_completed(jobs):
+        follower = jobs[f]
 
-                        gruta.log("ERROR",
-                            "ActivityPub-feed: %s POST ERROR '%s': %d, '%s'" % (
-                                uid, fid, status, body))
+        if follower.get("inbox") == "":
+            try:
+                status = f.result()
+            except Exception as e:
+                status = 500
+
+            _delivered(gruta, story, follower, status, "cannot get actor inbox")
 
-                    # update failure count
-                    follower.set("failures", str(failures))
+    # group the followers by shared inbox: each one gets a single copy
+    groups = {}
 
-                    gruta.log("INFO",
-                        "ActivityPub-feed: %s POST '%s' story: %s, sts: %s, fail#: %d" % (
-                        uid, fid, gruta.url(story), status, failures))
+    for follower in followers:
+        if follower.get("inbox") != "":
+            groups.setdefault(follower.get("shared_inbox") or follower.get("inbox"),
+                []).append(follower)
 
-                    # too many failures? disable follower
-                    if failures > 25:
-                        # disable user
-                        follower.set("disabled", "1")
+    # the same copy for all inboxes, built and digested once: addressed
+    # to the followers collection, so the receiving servers of shared
+    # inboxes forward it to their followers of this user
+    c = create(gruta, user, note, note["to"],
+        [gruta.aurl(uid, "activitypub/followers")])
 
-                        gruta.log("INFO",
-                            "ActivityPub-feed: %s DISABLED '%s' (too many failures)" % (
-                                uid, fid))
+    body = payload(c)
 
-                    # save changes in follower
-                    gruta.save_follower(follower)
+    jobs = {}
 
-                    # count one more post
-                    cnt += 1
+    for inbox, group in groups.items():
+        if len(group) == 1:
+            inbox = group[0].get("inbox")
 
-        # any posts for this story?
-        if cnt > 0:
-            # wait a reasonable time between stories to avoid hammering servers
-            t = 5 - (time.time() - t)
+        f = delivery.submit(inbox, send_to_inbox, gruta, user, inbox, c, body)
 
-            if t > 0:
-                time.sleep(t)
+        jobs[f] = group
+
+    # the followers are updated here, one at a time
+    for f in concurrent.futures.as_completed(jobs):
+        try:
+            status, body = f.result()
+        except Exception as e:
+            status, body = 500, str(e)
+
+        for follower in jobs[f]:
+            _delivered(gruta, story, follower, status, body)
+
+
+def _delivered(gruta, story, follower, status, body):
+    """ updates a follower after a delivery """
+
+    uid = story.get("userid")
+    fid = follower.get("id")
+
+    if status >= 200 and status <= 299:
+        # follower received the story
+        failures = 0
+        follower.set("ldate", story.get("date"))
+    else:
+        # account one more failure
+        failures = int(follower.get("failures") or "0") + 1
+
+        # get its inboxes again next time, in case they changed
+        follower.set("inbox",        "")
+        follower.set("shared_inbox", "")
+
+        try:
+            body = body.decode()
+        except:
+            body = str(body)
+
+        gruta.log("ERROR",
+            "ActivityPub-feed: %s POST ERROR '%s': %d, '%s'" % (
+                uid, fid, status, body))
+
+    # update failure count
+    follower.set("failures", str(failures))
+
+    gruta.log("INFO",
+        "ActivityPub-feed: %s POST '%s' story: %s, sts: %s, fail#: %d" % (
+        uid, fid, gruta.url(story), status, failures))
+
+    # too many failures? disable follower
+    if failures > 25:
+        # disable user
+        follower.set("disabled", "1")
+
+        gruta.log("INFO",
+            "ActivityPub-feed: %s DISABLED '%s' (too many failures)" % (
+                uid, fid))
+
+    # save changes in follower
+    gruta.save_follower(follower)
 
 
 # httpd handlers
 
+@pygruta.router.get(path="/.well-known/webfinger", ctype="application/json")
 def webfinger_get_handler(gruta, q_path, q_vars):
     """ webfinger GET handler """
 
     status, body = 0, None
 
-    if q_path == "/.well-known/webfinger":
-        try:
-            # resource is acct:user@hostname
-            res = q_vars["resource"][0]
-            q_user, q_host = res.replace("acct:", "").split("@")
-
-            if q_host == gruta.host_name:
-                # host matches; find user
-                user = get_user(gruta, q_user)
-
-                if user is not None:
-                    # user exists: create object
-                    body = {
-                        "subject": res,
-                        "links": [
-                            {
-                                "rel": "self",
-                                "type": "application/activity+json",
-                                "href": gruta.aurl(q_user, "activitypub/user")
-                            }
-                        ]
-                    }
+    try:
+        # resource is acct:user@hostname
+        res = q_vars["resource"][0]
+        q_user, q_host = res.replace("acct:", "").split("@")
+
+        if q_host == gruta.host_name:
+            # host matches; find user
+            user = get_user(gruta, q_user)
+
+            if user is not None:
+                # user exists: create object
+                body = {
+                    "subject": res,
+                    "links": [
+                        {
+                            "rel": "self",
+                            "type": "application/activity+json",
+                            "href": gruta.aurl(q_user, "activitypub/user")
+                        }
+                    ]
+                }
 
-                    body = json.dumps(body)
-                    status = 200
-        except:
-            pass
+                body = json.dumps(body)
+                status = 200
+    except:
+        pass
 
-    return status, body, "application/json"
+    return status, body
 
 
-def get_handler(gruta, q_path, q_vars):
-    """ ActivityPub GET handler """
+@pygruta.router.get(pattern="^/activitypub/user/.+", ctype="application/activity+json")
+def actor_get_handler(gruta, q_path, q_vars):
+    """ ActivityPub actor GET handler """
 
     status, body = 0, None
 
-    if re.search("^/activitypub/user/.+", q_path):
-
-        uid = q_path.split("/")[-1]
-        user = get_user(gruta, uid)
+    uid = q_path.split("/")[-1]
+    user = get_user(gruta, uid)
 
-        if user is not None:
-            actor  = gruta.aurl(uid, "activitypub/user")
-            inbox  = gruta.aurl(uid, "activitypub/inbox")
-            outbox = gruta.aurl(uid, "activitypub/outbox")
+    if user is not None:
+        actor  = gruta.aurl(uid, "activitypub/user")
+        inbox  = gruta.aurl(uid, "activitypub/inbox")
+        outbox = gruta.aurl(uid, "activitypub/outbox")
     
-            body = {
-                "@context": [
-                    "https://www.w3.org/ns/activitystreams",
-                    "https://w3id.org/security/v1"
-                    ],
-                "id": actor,
-                "url": user.get("url"),
-                "type": "Person",
-                "preferredUsername": uid,
-                "name": user.get("username"),
-                "inbox": inbox,
-                "outbox": outbox,
-                "followers": gruta.aurl(uid, "activitypub/followers"),
-                "following": gruta.aurl(uid, "activitypub/following"),
-                "liked": gruta.aurl(uid, "activitypub/liked"),
-                "summary": user.get("bio"),
-                "icon": {
-                    "mediaType": "image/jpeg",
-                    "type": "Image",
-                    "url": user.get("avatar")
-                },
-                "publicKey": {
-                    "id": actor + "#main-key",
-                    "owner": actor,
-                    "publicKeyPem": user.get("pubkey")
-                }
+        body = {
+            "@context": [
+                "https://www.w3.org/ns/activitystreams",
+                "https://w3id.org/security/v1"
+                ],
+            "id": actor,
+            "url": user.get("url"),
+            "type": "Person",
+            "preferredUsername": uid,
+            "name": user.get("username"),
+            "inbox": inbox,
+            "outbox": outbox,
+            "followers": gruta.aurl(uid, "activitypub/followers"),
+            "following": gruta.aurl(uid, "activitypub/following"),
+            "liked": gruta.aurl(uid, "activitypub/liked"),
+            "summary": user.get("bio"),
+            "icon": {
+                "mediaType": "image/jpeg",
+                "type": "Image",
+                "url": user.get("avatar")
+            },
+            "publicKey": {
+                "id": actor + "#main-key",
+                "owner": actor,
+                "publicKeyPem": user.get("pubkey")
             }
+        }
     
-            status, body = 200, json.dumps(body)
+        status, body = 200, json.dumps(body)
 
-        else:
-            status = 404
+    else:
+        status = 404
 
-    elif re.search("^/activitypub/outbox/.+", q_path):
-        status, body = 200, ""
+    return status, body
 
 
-    return status, body, "application/activity+json"
+@pygruta.router.get(pattern="^/activitypub/outbox/.+", ctype="application/activity+json")
+def outbox_get_handler(gruta, q_path, q_vars):
+    """ ActivityPub outbox GET handler """
+
+    return 200, ""
+
+
+# the inbox queue (None, not yet created; False, no queue)
+inbox_spool = None
+inbox_lock  = threading.Lock()
+
+def inbox_queue(gruta):
+    """ returns the inbox queue (None if there is no cfg_activitypub_queue) """
+
+    global inbox_spool
+
+    with inbox_lock:
+        if inbox_spool is None:
+            path = gruta.template("cfg_activitypub_queue")
+
+            if path != "":
+                try:
+                    workers = int(gruta.template("cfg_activitypub_workers") or "4")
+                    per_key = int(gruta.template("cfg_activitypub_host_limit") or "2")
+                except:
+                    workers, per_key = 4, 2
+
+                inbox_spool = pygruta.spool.Spool(path,
+                    lambda item: inbox_item(gruta, item),
+                    workers=workers, per_key=per_key, log=gruta.log)
+
+                inbox_spool.start()
+            else:
+                inbox_spool = False
+
+    return inbox_spool if inbox_spool is not False else None
+
+
+def inbox_item(gruta, item):
+    """ processes a queued inbox message (returns False to retry it) """
+
+    user = get_user(gruta, item["uid"])
+
+    if user is None:
+        return True
+
+    try:
+        status = inbox_process(gruta, user, item["data"])
+    except Exception as e:
+        # (a malformed message will not get any better)
+        gruta.log("ERROR", "ActivityPub: %s BAD INBOX MESSAGE DROPPED (%s)" % (
+            user.get("id"), e))
+        return True
+
+    # network or remote server errors are worth a retry
+    return status < 500
 
 
 def inbox_post_handler(gruta, q_path, q_vars, p_data):
@@ -568,244 +928,284 @@ def inbox_post_handler(gruta, q_path, q_vars, p_data):
     uid = q_path.split("/")[-1]
     user = get_user(gruta, uid)
 
-    dump_data = False
-
     if user is not None:
-        j = json.loads(p_data)
-
-        actor = gruta.aurl(uid, "activitypub/user")
-
-        if j["type"] == "Follow":
-            # Build an Accept request
-            # to acknowledge the following
-            o = {
-                "type": "Accept",
-                "id": "%s/%f" % (actor, time.time()),
-                "object": j,
-                "actor": actor,
-                "@context": [
-                    "https://www.w3.org/ns/activitystreams",
-                    "https://w3id.org/security/v1"
-                ]
-            }
+        try:
+            j = json.loads(p_data)
+            host = urllib.parse.urlsplit(j["actor"]).netloc
+            type = j["type"]
+        except:
+            j = None
 
-            gruta.log("INFO", "ActivityPub: %s FOLLOW REQUEST '%s'" % (
-                uid, j["actor"]));
+        if j is None:
+            status = 400
 
-            status, data = send_to_actor(gruta, user, j["actor"], o)
+        else:
+            q = inbox_queue(gruta)
 
-            if status >= 200 and status <= 299:
+            if q is not None:
+                # processed later, by host
+                q.put({"uid": uid, "data": p_data}, key=host)
 
-                # store as a follower: new posts
-                # will be sent to these people
+                gruta.log("DEBUG", "ActivityPub: %s QUEUED '%s' from '%s'" % (
+                    uid, type, j["actor"]))
 
-                if gruta.follower(uid, j["actor"]) is None:
-                    follower = gruta.new_follower({
-                        "id":       j["actor"],
-                        "user_id":  uid,
-                        "date":     gruta.today(),
-                        "context":  p_data,
-                        "network":  "activitypub"
-                        })
+                status = 202
+            else:
+                status = inbox_process(gruta, user, p_data)
 
-                    gruta.save_follower(follower)
-                    gruta.notify("ActivityPub: %s NEW FOLLOWER '%s'" % (
-                        uid, j["actor"]))
-                else:
-                    gruta.log("INFO", "ActivityPub: %s repeated follow request '%s'" % (
-                        uid, j["actor"]))
+    return status, body, "application/activity+json"
 
-                # created
-                status = 201
 
-            else:
-                try:
-                    data = data.decode()
-                except:
-                    data = str(data)
+def inbox_process(gruta, user, p_data):
+    """ processes an ActivityPub inbox message; returns an HTTP status """
 
-                gruta.log("ERROR", "ActivityPub: %s FOLLOW CONFIRM '%s' failed: '%s'" % (
-                    uid, j["actor"], data))
+    status = 404
 
-        elif j["type"] == "Undo":
-            o = j["object"]
-            gruta.log("INFO", "ActivityPub: UNDO object type '%s'" % o["type"])
+    uid = user.get("id")
 
-            if o["type"] == "Follow":
-                # delete from followers
-                try:
-                    follower = gruta.follower(user.get("id"), j["actor"])
-    
-                    if follower:
-                        gruta.delete_follower(follower)
-                        gruta.notify("ActivityPub: %s UNFOLLOW '%s'" % (uid, j["actor"]))
-    
-                        status = 200
-                    else:
-                        gruta.log("ERROR", "ActivityPub: %s BAD UNFOLLOW '%s'" % (
-                            uid, j["actor"]))
+    dump_data = False
+
+    j = json.loads(p_data)
+
+    actor = gruta.aurl(uid, "activitypub/user")
+
+    if j["type"] == "Follow":
+        # Build an Accept request
+        # to acknowledge the following
+        o = {
+            "type": "Accept",
+            "id": "%s/%f" % (actor, time.time()),
+            "object": j,
+            "actor": actor,
+            "@context": [
+                "https://www.w3.org/ns/activitystreams",
+                "https://w3id.org/security/v1"
+            ]
+        }
+
+        gruta.log("INFO", "ActivityPub: %s FOLLOW REQUEST '%s'" % (
+            uid, j["actor"]));
+
+        status, data = send_to_actor(gruta, user, j["actor"], o)
+
+        if status >= 200 and status <= 299:
+
+            # store as a follower: new posts
+            # will be sent to these people
+
+            if gruta.follower(uid, j["actor"]) is None:
+                follower = gruta.new_follower({
+                    "id":       j["actor"],
+                    "user_id":  uid,
+                    "date":     gruta.today(),
+                    "context":  p_data,
+                    "network":  "activitypub"
+                    })
 
-                        status = 403
+                # (just fetched by send_to_actor())
+                s, actor_o = cached_actor(gruta, j["actor"])
 
-                except:
-                    status = 402
+                if actor_o is not None:
+                    set_inboxes(gruta, follower, actor_o)
+
+                gruta.save_follower(follower)
+                gruta.notify("ActivityPub: %s NEW FOLLOWER '%s'" % (
+                    uid, j["actor"]))
             else:
-                gruta.log("WARN", "ActivityPub: %s Unhandled undo for type '%s'" % (
-                    uid, o["type"]))
+                gruta.log("INFO", "ActivityPub: %s repeated follow request '%s'" % (
+                    uid, j["actor"]))
 
-                dump_data = True
+            # created
+            status = 201
 
-        elif j["type"] == "Create" or j["type"] == "Update":
-            o = j["object"]
-            gruta.log("INFO", "ActivityPub: %s CREATE object type '%s'" % (uid, o["type"]))
+        else:
+            try:
+                data = data.decode()
+            except:
+                data = str(data)
 
-            if o["type"] == "Note" or o["type"] == "Article":
-                # It's a Note: store as a story
+            gruta.log("ERROR", "ActivityPub: %s FOLLOW CONFIRM '%s' failed: '%s'" % (
+                uid, j["actor"], data))
 
-                # ensure the topic 'activitypubs' exists
-                if gruta.topic("activitypubs") is None:
-                    topic = gruta.new_topic({
-                        "id":       "activitypubs",
-                        "name":     "ActivityPub posts",
-                        "internal": "1"
-                        }
-                    )
-                    gruta.save_topic(topic)
+    elif j["type"] == "Undo":
+        o = j["object"]
+        gruta.log("INFO", "ActivityPub: UNDO object type '%s'" % o["type"])
 
-                # build an id by hashing the full message
-                id = gruta.md5(p_data)
+        if o["type"] == "Follow":
+            # delete from followers
+            try:
+                follower = gruta.follower(user.get("id"), j["actor"])
+    
+                if follower:
+                    gruta.delete_follower(follower)
+                    gruta.notify("ActivityPub: %s UNFOLLOW '%s'" % (uid, j["actor"]))
+    
+                    status = 200
+                else:
+                    gruta.log("ERROR", "ActivityPub: %s BAD UNFOLLOW '%s'" % (
+                        uid, j["actor"]))
 
-                # get message data
-                actor     = j["actor"]
-                text      = o["content"]
-                redir     = o["id"]
-                context   = p_data
+                    status = 403
 
-                status, actor_o = get_actor(actor)
+            except:
+                status = 402
+        else:
+            gruta.log("WARN", "ActivityPub: %s Unhandled undo for type '%s'" % (
+                uid, o["type"]))
 
-                if actor_o:
-                    actor_username = actor_o["preferredUsername"]
-                else:
-                    actor_username = actor
+            dump_data = True
 
-                if o.get("name"):
-                    title = o["name"]
-                elif o.get("summary"):
-                    title = o["summary"]
-                else:
-                    title = "Message from " + actor_username
+    elif j["type"] == "Create" or j["type"] == "Update":
+        o = j["object"]
+        gruta.log("INFO", "ActivityPub: %s CREATE object type '%s'" % (uid, o["type"]))
 
-                story = gruta.story("activitypubs", id)
+        if o["type"] == "Note" or o["type"] == "Article":
+            # It's a Note: store as a story
 
-                if story is None:
-                    story = gruta.new_story({
-                        "topic_id": "activitypubs",
-                        "id":       id
-                    })
+            # ensure the topic 'activitypubs' exists
+            if gruta.topic("activitypubs") is None:
+                topic = gruta.new_topic({
+                    "id":       "activitypubs",
+                    "name":     "ActivityPub posts",
+                    "internal": "1"
+                    }
+                )
+                gruta.save_topic(topic)
 
-                content = "<h2>" + title + "</h2>\n"
-                content += "<p><a href =\"" + redir + "\">Message</a>"
-                content += " from <a href=\"" + actor + "\">" + actor_username + "</a>"
-                content += " to " + uid + ":</p>\n"
-                content += "<blockquote>\n" + text + "</blockquote>\n"
-                content += "<p></p>\n"
+            # build an id by hashing the full message
+            id = gruta.md5(p_data)
 
-                # does the message include attachments?
-                l = o.get("attachment")
+            # get message data
+            actor     = j["actor"]
+            text      = o["content"]
+            redir     = o["id"]
+            context   = p_data
 
-                if isinstance(l, list) and len(l) > 0:
-                    a = l[0]
+            status, actor_o = cached_actor(gruta, actor)
 
-                    # an image: add an img tag
-                    if a["mediaType"] in ["image/jpeg", "image/gif", "image/png"]:
-                        content += "<p><img src=\"" + a["url"] + "\"/></p>"
-                        content += "<p></p>\n"
+            if actor_o:
+                actor_username = actor_o["preferredUsername"]
+            else:
+                actor_username = actor
 
-                story.set("title",      title)
-                story.set("redir",      redir)
-                story.set("context",    context)
-                story.set("content",    content)
-                story.set("full_story", "1")
+            if o.get("name"):
+                title = o["name"]
+            elif o.get("summary"):
+                title = o["summary"]
+            else:
+                title = "Message from " + actor_username
 
-                gruta.save_story(story)
+            story = gruta.story("activitypubs", id)
 
-                gruta.notify("ActivityPub: %s NEW MESSAGE '%s'" % (uid, redir))
+            if story is None:
+                story = gruta.new_story({
+                    "topic_id": "activitypubs",
+                    "id":       id
+                })
 
-                status = 201
+            content = "<h2>" + title + "</h2>\n"
+            content += "<p><a href =\"" + redir + "\">Message</a>"
+            content += " from <a href=\"" + actor + "\">" + actor_username + "</a>"
+            content += " to " + uid + ":</p>\n"
+            content += "<blockquote>\n" + text + "</blockquote>\n"
+            content += "<p></p>\n"
 
-        elif j["type"] == "Like" or j["type"] == "Announce":
-            # build an id by hashing the full message
-            new_id = gruta.md5(p_data)
+            # does the message include attachments?
+            l = o.get("attachment")
 
-            # get info about the actor
-            status, actor_o = get_actor(j["actor"])
+            if isinstance(l, list) and len(l) > 0:
+                a = l[0]
 
-            # get the story that is being liked
-            object = j["object"]
-            object = re.sub("^" + gruta.aurl(), "", object)
-            object = re.sub("\.html.*$", "", object)
+                # an image: add an img tag
+                if a["mediaType"] in ["image/jpeg", "image/gif", "image/png"]:
+                    content += "<p><img src=\"" + a["url"] + "\"/></p>"
+                    content += "<p></p>\n"
 
-            try:
-                topic_id, id = object.split("/")
-                story = gruta.story(topic_id, id)
-            except:
-                story = None
+            story.set("title",      title)
+            story.set("redir",      redir)
+            story.set("context",    context)
+            story.set("content",    content)
+            story.set("full_story", "1")
 
-            if j["type"] == "Like":
-                symbol = "&#9733;"
-                verb   = "liked"
-            else:
-                symbol = "&#8634;"
-                verb   = "boosted"
-
-            if story is not None:
-                content = "<h2>" + symbol + " " + story.get("title") + "</h2>\n"
-                content += "<p><a href=\"" + j["actor"] + "\">"
-                content += actor_o["preferredUsername"] + "</a>"
-                content += " " + verb + " story://%s/%s</p>" % (topic_id, id)
-
-                # get the local page, stripping the #pygruta-stuff
-                reference = re.sub("#.*$", "", j["object"])
-
-                new_story = gruta.new_story({
-                    "id":           new_id,
-                    "topic_id":     "activitypubs",
-                    "content":      content,
-                    "full_story":   "1",
-                    "context":      p_data,
-                    "reference":    reference
-                })
+            gruta.save_story(story)
 
-                gruta.save_story(new_story)
+            gruta.notify("ActivityPub: %s NEW MESSAGE '%s'" % (uid, redir))
 
-                gruta.notify("ActivityPub: %s REACTION from '%s' to '%s'" % (
-                    uid, j["actor"], j["object"]))
+            status = 201
 
-                status = 200
-            else:
-                gruta.log("ERROR",
-                    "ActivityPub: %s REACTION invalid for '%s'" % (uid, j["object"]))
+    elif j["type"] == "Like" or j["type"] == "Announce":
+        # build an id by hashing the full message
+        new_id = gruta.md5(p_data)
 
-        elif j["type"] == "Delete":
-            # is this actor following us?
-            follower = gruta.follower(user.get("id"), j["actor"])
+        # get info about the actor
+        status, actor_o = cached_actor(gruta, j["actor"])
 
-            if follower is not None:
-                gruta.delete_follower(follower)
-                gruta.notify("ActivityPub: %s DELETED '%s'" % (uid, j["actor"]))
+        # get the story that is being liked
+        object = j["object"]
+        object = re.sub("^" + gruta.aurl(), "", object)
+        object = re.sub("\.html.*$", "", object)
 
-            else:
-                # ignore Delete queries
-                gruta.log("INFO", "ActivityPub: %s DELETE ignored for '%s'" % (
-                    uid, j["actor"]))
+        try:
+            topic_id, id = object.split("/")
+            story = gruta.story(topic_id, id)
+        except:
+            story = None
+
+        if j["type"] == "Like":
+            symbol = "&#9733;"
+            verb   = "liked"
+        else:
+            symbol = "&#8634;"
+            verb   = "boosted"
+
+        if story is not None:
+            content = "<h2>" + symbol + " " + story.get("title") + "</h2>\n"
+            content += "<p><a href=\"" + j["actor"] + "\">"
+            content += actor_o["preferredUsername"] + "</a>"
+            content += " " + verb + " story://%s/%s</p>" % (topic_id, id)
+
+            # get the local page, stripping the #pygruta-stuff
+            reference = re.sub("#.*$", "", j["object"])
+
+            new_story = gruta.new_story({
+                "id":           new_id,
+                "topic_id":     "activitypubs",
+                "content":      content,
+                "full_story":   "1",
+                "context":      p_data,
+                "reference":    reference
+            })
+
+            gruta.save_story(new_story)
+
+            gruta.notify("ActivityPub: %s REACTION from '%s' to '%s'" % (
+                uid, j["actor"], j["object"]))
 
             status = 200
+        else:
+            gruta.log("ERROR",
+                "ActivityPub: %s REACTION invalid for '%s'" % (uid, j["object"]))
+
+    elif j["type"] == "Delete":
+        # is this actor following us?
+        follower = gruta.follower(user.get("id"), j["actor"])
+
+        if follower is not None:
+            gruta.delete_follower(follower)
+            gruta.notify("ActivityPub: %s DELETED '%s'" % (uid, j["actor"]))
 
         else:
-            gruta.log("WARN", "ActivityPub: %s Unhandled type '%s'" % (uid, j["type"]))
-            dump_data = True
+            # ignore Delete queries
+            gruta.log("INFO", "ActivityPub: %s DELETE ignored for '%s'" % (
+                uid, j["actor"]))
+
+        status = 200
+
+    else:
+        gruta.log("WARN", "ActivityPub: %s Unhandled type '%s'" % (uid, j["type"]))
+        dump_data = True
 
     if dump_data is True:
         gruta.log("DEBUG", "ActivityPub: %s p_data: %s" % (uid, p_data))
 
-    return status, body, "application/activity+json"
+    return status
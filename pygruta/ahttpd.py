@@ -0,0 +1,250 @@
+#
+#   pygruta CMS
+#   ttcdt <dev@triptico.com>
+#
+#   This software is released into the public domain.
+#
+
+#   asyncio HTTP server
+
+import asyncio
+import concurrent.futures
+import http.client
+import io
+import os
+
+import pygruta
+from pygruta.httpd import httpd_handler, setup_handler
+
+class request_handler(httpd_handler):
+    """ an httpd_handler run on an already read request,
+        writing the response into a buffer """
+
+    def __init__(self, server, client_address, method, path, version, headers, body):
+        # (BaseHTTPRequestHandler's would start reading from a socket)
+        self.server           = server
+        self.client_address   = client_address
+        self.command          = method
+        self.path             = path
+        self.request_version  = version
+        self.requestline      = "%s %s %s" % (method, path, version)
+        self.headers          = headers
+        self.rfile            = io.BytesIO(body)
+        self.wfile            = io.BytesIO()
+        self.protocol_version = "HTTP/1.1"
+        self.close_connection = False
+
+        # (file object, offset, count) to be sent after the response
+        self.file             = None
+
+    def _write_file(self, f, offset, count):
+        # the server sends it from the event loop (the caller closes f)
+        self.file = (os.fdopen(os.dup(f.fileno()), "rb"), offset, count)
+
+    def run(self):
+        """ handles the request, returning the full response
+            and the file to be sent as its body (if any) """
+
+        method = getattr(self, "do_" + self.command, None)
+
+        try:
+            if method is None:
+                self.send_error(501, "Unsupported method (%r)" % self.command)
+            else:
+                method()
+        finally:
+            self._end_profile()
+
+        self.wfile.flush()
+
+        return self.wfile.getvalue(), self.file
+
+
+class ahttpd_server:
+    def __init__(self, gruta, address, port, threads):
+        self.gruta   = gruta
+        self.address = address
+        self.port    = port
+
+        # cache misses (and POSTs) are handled here
+        self.pool    = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+        # seconds an idle connection is kept open
+        self.timeout = 60
+
+        # maximum size of request headers
+        self.max_headers = 65536
+
+        # maximum size of request bodies
+        self.max_body    = 16 * 1024 * 1024
+
+    def frame(self, response, method, keep_alive, file=None):
+        """ sets the Content-Length and Connection headers of a response """
+
+        head, body = response.split(b"\r\n\r\n", 1)
+        head = [h for h in head.split(b"\r\n")
+                if not h.lower().startswith((b"connection:", b"content-length:"))]
+
+        status = int(head[0].split()[1])
+
+        if method != "HEAD" and status >= 200 and status not in (204, 304):
+            head.append(b"Content-Length: %d" % (len(body) + (file[2] if file else 0)))
+
+        head.append(b"Connection: keep-alive" if keep_alive else b"Connection: close")
+
+        return b"\r\n".join(head) + b"\r\n\r\n" + body
+
+    def error(self, status, message):
+        return (b"HTTP/1.1 %d %s\r\nContent-Type: text/html\r\n\r\n"
+                b"<h1>%d %s</h1>" % (status, message, status, message))
+
+    async def request(self, reader, writer):
+        """ reads and handles a request; returns False to close """
+
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        if line == b"":
+            return False
+
+        line = line.decode("latin-1").strip()
+
+        if line == "":
+            # stray empty line between requests
+            return True
+
+        req = line.split()
+
+        if len(req) != 3 or not req[2].startswith("HTTP/1."):
+            writer.write(self.frame(self.error(400, b"Bad Request"), "", False))
+            return False
+
+        method, path, version = req
+
+        raw = b""
+
+        while True:
+            h = await reader.readline()
+            raw += h
+
+            if h in (b"\r\n", b"\n", b""):
+                break
+
+            if len(raw) > self.max_headers:
+                writer.write(self.frame(
+                    self.error(431, b"Request Header Fields Too Large"), "", False))
+                return False
+
+        headers = http.client.parse_headers(io.BytesIO(raw))
+
+        if headers.get("Transfer-Encoding"):
+            writer.write(self.frame(self.error(411, b"Length Required"), "", False))
+            return False
+
+        body = b""
+        l    = int(headers.get("Content-Length") or "0")
+
+        if l < 0:
+            writer.write(self.frame(self.error(400, b"Bad Request"), "", False))
+            return False
+
+        if l > self.max_body:
+            writer.write(self.frame(
+                self.error(413, b"Payload Too Large"), "", False))
+            return False
+
+        if l > 0:
+            body = await reader.readexactly(l)
+
+        conn = (headers.get("Connection") or "").lower()
+
+        if version == "HTTP/1.1":
+            keep_alive = conn != "close"
+        else:
+            keep_alive = conn == "keep-alive"
+
+        peer = writer.get_extra_info("peername") or ("", 0)
+        args = (self, peer, method, path, version, headers, body)
+
+        loop     = asyncio.get_running_loop()
+        response = None
+
+        if method == "GET":
+            # cache hits are served right here
+            h = request_handler(*args)
+            h.cache_only = True
+
+            response, file = h.run()
+
+            if h.missed:
+                response = None
+            else:
+                # periodic flushes can do I/O, so keep them out of the loop
+                loop.run_in_executor(self.pool, self.gruta.timed_flush)
+
+        if response is None:
+            h = request_handler(*args)
+
+            response, file = await loop.run_in_executor(self.pool, h.run)
+
+        writer.write(self.frame(response, method, keep_alive, file))
+
+        if file is not None:
+            f, offset, count = file
+
+            try:
+                await writer.drain()
+
+                # zero-copy (if the OS and the transport allow it)
+                await loop.sendfile(writer.transport, f, offset, count)
+            finally:
+                f.close()
+
+        await writer.drain()
+
+        return keep_alive
+
+    async def client(self, reader, writer):
+        try:
+            # pipelined requests are waiting in the reader, in order
+            while await self.request(reader, writer):
+                pass
+
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.client, self.address, self.port)
+
+        async with server:
+            await server.serve_forever()
+
+
+def ahttpd(gruta, address="localhost", port=8000):
+    """ starts the asyncio httpd server """
+
+    try:
+        threads = int(gruta.template("cfg_httpd_threads") or "8")
+    except:
+        threads = 8
+
+    setup_handler(request_handler, gruta)
+
+    server = ahttpd_server(gruta, address, port, threads)
+
+    gruta.log("INFO",
+        "httpd: START %s:%s [pygruta %s, asyncio, %d threads]" % (address, port,
+        pygruta.__version__, threads))
+
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+    server.pool.shutdown(wait=True)
+    gruta.log("INFO", "httpd: STOP %s:%s" % (address, port))
@@ -7,10 +7,13 @@
 
 #   base classes
 
-import datetime, re, hashlib, time, os
+import datetime, re, hashlib, hmac, time, os, threading
 import pygruta
 import pygruta.cache
 import pygruta.http
+import pygruta.router
+import pygruta.metrics
+import pygruta.logwriter
 
 import pygruta.html as html
 import pygruta.xml as xml
@@ -85,14 +88,28 @@ class Follower(O):
     def __init__(self, data={}):
         super().__init__(fields=[
             "id", "user_id", "context", "date", "network",
-            "ldate", "failures", "disabled"
+            "ldate", "failures", "disabled", "inbox", "shared_inbox", "adate"
         ], data=data)
 
 
 # Gruta source base object
 
 class Gruta:
+    # log file writer (None, not yet open; False, no log file)
+    log_writer  = None
+    log_lock    = threading.RLock()
+    log_opening = False
+
+    # is stdout a tty?
+    log_tty = os.isatty(1)
+
     def __init__(self):
+        # per-request (thread) state
+        self.local = threading.local()
+
+        # objects the cached pages are being built from
+        self.deps = pygruta.cache.Deps()
+
         # store the host_name
         self.host_name = self.template("cfg_host_name")
 
@@ -111,21 +128,62 @@ class Gruta:
         # debug flag (if 0, log messages of DEBUG category don't show)
         self.debug = 0
 
-        self.html_cache = pygruta.cache.Cache()
-        self.page_cache = pygruta.cache.Cache()
+        self.html_cache = self._new_cache("html", 10000, 16 * 1024 * 1024)
+        self.page_cache = self._new_cache("page", 5000, 64 * 1024 * 1024)
 
         # timed flush information
         self.timed_flush_max  = 24 * 60 * 60
         self.timed_flush_last = time.time()
 
+        # pending story hits, stored in batches
+        self.hits = {}
+        self.hits_flush_max  = 60
+        self.hits_flush_last = time.time()
+        self.hits_lock = threading.Lock()
+
+        # (flushes are serialized, but don't block hit())
+        self.hits_flush_lock = threading.Lock()
+
+    @property
+    def logged_user(self):
+        """ user logged in the current request ("" if none) """
+        return getattr(self.local, "logged_user", "")
+
+    @logged_user.setter
+    def logged_user(self, user_id):
+        self.local.logged_user = user_id
+
+    @property
+    def request_token(self):
+        """ X-Gruta-Token of the current request ("" if none) """
+        return getattr(self.local, "request_token", "")
+
+    @request_token.setter
+    def request_token(self, token):
+        self.local.request_token = token
+
+    def admin_request(self):
+        """ does the current request carry the admin token? """
+
+        # (cfg_token also closes the whole site to requests without it)
+        token = self.template("cfg_admin_token") or self.template("cfg_token")
+
+        return token != "" and hmac.compare_digest(token.encode(),
+            self.request_token.encode())
+
     def flush(self):
         """ flushes possible pending data in memory """
+        self.flush_hits()
         self._flush()
         self.log("INFO", "FLUSH")
 
     def timed_flush(self):
         """ flushes if the counter timeouts """
         t = time.time()
+
+        if len(self.hits) and t - self.hits_flush_last > self.hits_flush_max:
+            self.flush_hits()
+
         r = self.timed_flush_max - (t - self.timed_flush_last)
 
         if r < 0:
@@ -135,8 +193,46 @@ class Gruta:
         return r
 
     def close(self):
+        self.flush_hits()
         self._close()
 
+        if self.log_writer:
+            self.log_writer.close()
+            self.log_writer = None
+
+    def _stamp(self):
+        """ returns a value that changes when the source is modified
+            (None if the source cannot tell) """
+        return None
+
+
+    def _new_cache(self, name, max_entries, max_bytes):
+        """ creates a cache, with limits from cfg_{name}_cache_max_*
+            and seconds to keep serving expired entries from
+            cfg_{name}_cache_stale; if cfg_{name}_cache_path is set,
+            it's shared among processes (i.e. /dev/shm/pygruta-mysite) """
+
+        def cfg(id, default):
+            try:
+                return int(self.template("cfg_%s_cache_%s" % (name, id)))
+            except:
+                return default
+
+        path = self.template("cfg_%s_cache_path" % name)
+
+        if path != "":
+            return pygruta.cache.SharedCache(path,
+                max_entries=cfg("max_entries", max_entries),
+                max_bytes=cfg("max_bytes", max_bytes),
+                stale=cfg("stale", 0),
+                deps=self.deps)
+
+        return pygruta.cache.Cache(
+            max_entries=cfg("max_entries", max_entries),
+            max_bytes=cfg("max_bytes", max_bytes),
+            stale=cfg("stale", 0),
+            deps=self.deps)
+
 
     def clear_caches(self):
         """ clears internal caches, if needed """
@@ -145,6 +241,38 @@ class Gruta:
         self.page_cache.clear()
 
 
+    def invalidate(self, what, id="", topic_id="", tags=None):
+        """ drops the cached data built from a modified object """
+
+        if what == "story":
+            # the story itself, the story sets of its topic
+            # and the ones selected by its tags (all, if unknown)
+            keys = ["story:%s/%s" % (topic_id, id), "index:" + topic_id, "index"]
+
+            if tags is None:
+                self._invalidate(lambda k: k in keys or k.startswith("tag:"))
+            else:
+                self._invalidate(keys + ["tag:" + t for t in tags])
+
+        elif what == "index":
+            self._invalidate(lambda k: k.startswith("index") or k.startswith("tag:"))
+
+        elif what == "topic":
+            # pages that list topics depend on all of them
+            self._invalidate(lambda k: k.startswith("topic:"))
+
+        elif what == "image":
+            self.page_cache.put("/img/" + id, None)
+
+        else:
+            # users and templates
+            self._invalidate(["%s:%s" % (what, id)])
+
+    def _invalidate(self, keys):
+        self.html_cache.invalidate(keys)
+        self.page_cache.invalidate(keys)
+
+
     # helping functions
 
     def is_subset_of(self, subset, superset):
@@ -219,21 +347,28 @@ class Gruta:
         # build message
         s = pygruta.log_str(category, string)
 
-        # get log file (i.e. /home/angel/log/pygruta-triptico-%Y%m%d.log)
-        lf = self.template("cfg_log_file")
+        if self.log_writer is None:
+            with self.log_lock:
+                # (logging while reading the template goes nowhere)
+                if self.log_writer is None and not self.log_opening:
+                    self.log_opening = True
 
-        if lf != "":
-            # lf can be strftime()-tagged
-            lf = datetime.datetime.now().strftime(lf)
+                    # get log file (i.e. /home/angel/log/pygruta-triptico-%Y%m%d.log);
+                    # it can be strftime()-tagged
+                    lf = self._template("cfg_log_file")
 
-            try:
-                with open(lf, "a") as f:
-                    f.write(s + "\n")
-            except:
-                pass
+                    if lf != "":
+                        self.log_writer = pygruta.logwriter.LogWriter(lf)
+                    else:
+                        self.log_writer = False
+
+                    self.log_opening = False
+
+        if self.log_writer:
+            self.log_writer.write(s)
 
         # if stdout is a tty, also print there
-        if os.isatty(1):
+        if self.log_tty:
             print(s, flush=True)
 
 
@@ -248,9 +383,14 @@ class Gruta:
     def topic(self, id):
         """ opens an existent topic """
 
+        self.deps.add("topic:" + id)
+
         if self.valid_id(id):
+            t = time.perf_counter()
             topic = Topic({"id": id})
             topic = self._load_topic(topic)
+            pygruta.metrics.observe("pygruta_load_seconds", time.perf_counter() - t,
+                object="topic")
         else:
             topic = None
 
@@ -267,6 +407,8 @@ class Gruta:
         """ saves a topic """
 
         if self.valid_id(topic.get("id")):
+            self.invalidate("topic", topic.get("id"))
+
             topic = self._save_topic(topic)
         else:
             topic = None
@@ -279,9 +421,14 @@ class Gruta:
     def story(self, topic_id, id):
         """ opens an existent story """
 
+        self.deps.add("story:%s/%s" % (topic_id, id))
+
         if self.valid_id(topic_id) and self.valid_id(id):
+            t = time.perf_counter()
             story = Story({"topic_id": topic_id, "id": id})
             story = self._load_story(story)
+            pygruta.metrics.observe("pygruta_load_seconds", time.perf_counter() - t,
+                object="story")
         else:
             story = None
 
@@ -376,9 +523,15 @@ class Gruta:
                 # increment revision
                 story.set("revision", str(int(story.get("revision")) + 1))
 
+                id   = story.get("id")
+                tags = self._stored_tags(topic_id, id) + list(story.get("tags"))
+
                 # do the real save
                 story = self._save_story(story)
 
+                # (after it, so nothing is cached again from the old one)
+                self.invalidate("story", id, topic_id, tags=tags)
+
             else:
                 story = None
 
@@ -391,7 +544,84 @@ class Gruta:
     def delete_story(self, story):
         """ deletes a story """
 
-        return self._delete_story(story)
+        topic_id = story.get("topic_id")
+        id       = story.get("id")
+        tags     = self._stored_tags(topic_id, id) + list(story.get("tags"))
+
+        ret = self._delete_story(story)
+
+        self.invalidate("story", id, topic_id, tags=tags)
+
+        return ret
+
+    def _stored_tags(self, topic_id, id):
+        """ returns the tags of a story as currently stored """
+
+        story = self._load_story(Story({"topic_id": topic_id, "id": id}))
+
+        return list(story.get("tags")) if story is not None else []
+
+
+    def story_set(self, topics=None, tags=None, content=None, order="date",
+                  d_from=None, d_to=None, num=None, offset=0, private=False,
+                  timeout=None):
+        """ returns the (topic_id, id, date, tags, udate) of a set of stories """
+
+        # record which stories can change this set
+        if topics is not None:
+            self.deps.add(*["index:" + t for t in topics])
+        elif tags is not None and len([t for t in tags if t[0] == "!"]) == 0:
+            self.deps.add(*["tag:" + t for t in tags])
+        else:
+            self.deps.add("index")
+
+        def timed(set):
+            t = time.perf_counter()
+
+            yield from set
+
+            pygruta.metrics.observe("pygruta_load_seconds", time.perf_counter() - t,
+                object="story_set")
+
+        return timed(self._story_set(topics=topics, tags=tags, content=content,
+            order=order, d_from=d_from, d_to=d_to, num=num, offset=offset,
+            private=private, timeout=timeout))
+
+
+    def hit(self, topic_id, id):
+        """ counts a view of a story (stored on next flush_hits()) """
+
+        k = (topic_id, id)
+
+        with self.hits_lock:
+            self.hits[k] = self.hits.get(k, 0) + 1
+
+
+    def flush_hits(self):
+        """ stores the pending story hits """
+
+        with self.hits_flush_lock:
+            with self.hits_lock:
+                hits, self.hits = self.hits, {}
+                self.hits_flush_last = time.time()
+
+            stories = []
+
+            for (topic_id, id), n in hits.items():
+                story = self.story(topic_id, id)
+
+                if story is not None:
+                    try:
+                        n += int(story.get("hits").strip() or "0")
+                    except:
+                        pass
+
+                    story.set("hits", str(n))
+                    stories.append(story)
+
+            if len(stories):
+                self._save_hits(stories)
+                self.log("DEBUG", "HITS stored for %d stories" % len(stories))
 
 
     # USERS
@@ -399,9 +629,14 @@ class Gruta:
     def user(self, id):
         """ returns an existent user """
 
+        self.deps.add("user:" + id)
+
         if self.valid_id(id):
+            t = time.perf_counter()
             user = User({"id": id})
             user = self._load_user(user)
+            pygruta.metrics.observe("pygruta_load_seconds", time.perf_counter() - t,
+                object="user")
         else:
             user = None
 
@@ -416,6 +651,8 @@ class Gruta:
         """ saves a user """
 
         if self.valid_id(user.get("id")):
+            self.invalidate("user", user.get("id"))
+
             user = self._save_user(user)
         else:
             user = None
@@ -432,6 +669,20 @@ class Gruta:
     def new_follower(self, o={}):
         return Follower(o)
 
+    def follower_matches(self, follower, network=None, active=False, ldate=None):
+        """ tests a follower against the followers() filters """
+
+        if network is not None and follower.get("network") != network:
+            return False
+
+        if active and follower.get("disabled") == "1":
+            return False
+
+        if ldate is not None and follower.get("ldate") >= ldate:
+            return False
+
+        return True
+
     def save_follower(self, follower):
         if follower.get("user_id") == "":
             raise KeyError("user_id")
@@ -442,6 +693,21 @@ class Gruta:
         return self._save_follower(follower)
 
 
+    # TEMPLATES
+
+    def template(self, id):
+        """ returns a template ("" if it does not exist) """
+
+        self.deps.add("template:" + id)
+
+        t = time.perf_counter()
+        s = self._template(id)
+        pygruta.metrics.observe("pygruta_load_seconds", time.perf_counter() - t,
+            object="template")
+
+        return s
+
+
     # IMAGES
 
     def valid_image_id(self, id):
@@ -458,9 +724,23 @@ class Gruta:
             mt = "image/png"
         elif id.endswith(".ico"):
             mt = "image/x-icon"
+        elif id.endswith(".webp"):
+            mt = "image/webp"
+        elif id.endswith(".svg"):
+            mt = "image/svg+xml"
+        elif id.endswith(".mp3"):
+            mt = "audio/mpeg"
+        elif id.endswith(".ogg"):
+            mt = "audio/ogg"
+        elif id.endswith(".mp4"):
+            mt = "video/mp4"
 
         return mt
 
+    def image_file(self, id):
+        """ returns the path to the file of an image, if it has one """
+        return None
+
 
     # SHORTENED URLS
 
@@ -841,31 +1121,8 @@ class Gruta:
     def get_handler(self, q_path, q_vars={}):
         """ global GET handler """
 
-        status, body, ctype = 0, None, None
-
-        # cascade all the handler
-
         self.log("DEBUG", "get_handler: %s" % q_path)
 
-        if status == 0:
-            # calendar before html
-            status, body, ctype = calendar.get_handler(self, q_path, q_vars)
-
-        if status == 0:
-            status, body, ctype = html.get_handler(self, q_path, q_vars)
-
-        if status == 0:
-            status, body, ctype = xml.get_handler(self, q_path, q_vars)
-
-        if status == 0:
-            status, body, ctype = text.get_handler(self, q_path, q_vars)
-
-        if status == 0:
-            status, body, ctype = activitypub.get_handler(self, q_path, q_vars)
-
-        if status == 0:
-            status, body, ctype = activitypub.webfinger_get_handler(
-                                self, q_path, q_vars)
-
-
-        return status, body, ctype
+        # routes are registered by the html, xml, text, calendar
+        # and activitypub modules
+        return pygruta.router.routes.dispatch(self, q_path, q_vars)
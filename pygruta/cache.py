@@ -5,59 +5,517 @@
 #   This software is released into the public domain.
 #
 
-import time
+import time, os, json, hashlib, threading, shutil
+from collections import OrderedDict
+
+class Deps(threading.local):
+    """ records the objects (as keys like 'story:topic/id')
+        that cache entries are built from (one recording per thread) """
+
+    def __init__(self):
+        self.stack = []
+
+    def reset(self):
+        self.stack = []
+
+    def start(self):
+        self.stack.append(set())
+
+    def stop(self):
+        return self.stack.pop() if len(self.stack) else set()
+
+    def add(self, *keys):
+        # nested recordings get them too
+        for s in self.stack:
+            s.update(keys)
+
 
 class Cache:
-    def __init__(self, ttl=3600):
-        self.data  = {}
+    def __init__(self, ttl=3600, max_entries=0, max_bytes=0, sweep=60, deps=None,
+                stale=0):
+        # entries, in least to most recently used order
+        self.data  = OrderedDict()
         self.ttl   = ttl
         self.rtime = time.time()
 
+        # seconds expired entries are still kept (see get_stale())
+        self.stale = stale
+
+        # dependency recorder, and key -> set of indexes
+        self.deps  = deps
+        self.rdeps = {}
+
+        # limits (0, unlimited)
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+
+        # size of all objects
+        self.bytes = 0
+
+        # seconds between sweeps of expired entries
+        self.sweep = sweep
+        self.stime = time.time()
+
+        # counters
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+        # it can be shared by several threads
+        self.lock = threading.RLock()
+
+    def _size(self, object):
+        """ approximate size of an object """
+
+        if isinstance(object, (str, bytes)):
+            return len(object)
+
+        if isinstance(object, (list, tuple)):
+            return sum([self._size(o) for o in object])
+
+        return 0
+
+    def _pop(self, index):
+        ce = self.data.pop(index, None)
+
+        if ce is not None:
+            self.bytes -= ce["size"]
+
+            for k in ce["deps"]:
+                s = self.rdeps.get(k)
+
+                if s is not None:
+                    s.discard(index)
+
+                    if len(s) == 0:
+                        del self.rdeps[k]
+
+        return ce
+
+    def _sweep(self):
+        """ deletes all expired entries """
+
+        t = time.time()
+
+        for index in [i for i, ce in self.data.items()
+                        if t >= ce["expires"] + self.stale]:
+            self._pop(index)
+
+        self.stime = t
+
     def get(self, index, tag=""):
         """ gets an object from a cache """
 
-        object, state, context = None, 0, ""
+        object, state, context, stale = self.get_stale(index, tag, False)
 
-        ce = self.data.get(index)
+        return object, state, context
 
-        if ce is not None:
-            if time.time() < ce["expires"]:
-                # cache hit
-                object  = ce["object"]
-                context = ce["context"]
+    def get_stale(self, index, tag="", accept=True):
+        """ gets an object from a cache, also returning if it's expired
+            (but still within the stale period, if accept is set) """
 
-                if ce["tag"] == tag:
-                    # same tag: client already has it
-                    state = 1
-                else:
-                    # different or no tag: we have it but client don't
-                    state = -1
+        with self.lock:
+            object, state, context, stale = None, 0, "", False
+
+            ce = self.data.get(index)
+
+            if ce is not None:
+                t = time.time()
+
+                if t < ce["expires"] or (accept and t < ce["expires"] + self.stale):
+                    # cache hit
+                    object  = ce["object"]
+                    context = ce["context"]
+                    stale   = t >= ce["expires"]
+
+                    if ce["tag"] == tag:
+                        # same tag: client already has it
+                        state = 1
+                    else:
+                        # different or no tag: we have it but client don't
+                        state = -1
+
+                    # most recently used
+                    self.data.move_to_end(index)
+
+                    # whatever is being built depends on this too
+                    if self.deps is not None and len(ce["deps"]):
+                        self.deps.add(*ce["deps"])
+                elif t >= ce["expires"] + self.stale:
+                    # expired
+                    self._pop(index)
+
+            if object is None:
+                self.misses += 1
             else:
-                # expired
-                self.data.pop(index)
+                self.hits += 1
+
+            return object, state, context, stale
+
+    def put(self, index, object, ttl=120, tag="", context="", deps=None):
+        """ puts an object into a cache """
+
+        with self.lock:
+            # time to sweep?
+            if time.time() > self.stime + self.sweep:
+                self._sweep()
+
+            self._pop(index)
+
+            if object is not None:
+                size = self._size(object)
+
+                self.data[index] = {
+                    "object":   object,
+                    "expires":  time.time() + ttl,
+                    "tag":      tag,
+                    "context":  context,
+                    "size":     size,
+                    "deps":     deps or set()
+                }
+
+                self.bytes += size
+
+                for k in self.data[index]["deps"]:
+                    self.rdeps.setdefault(k, set()).add(index)
+
+                # evict the least recently used entries
+                while len(self.data) > 1 and (
+                    (self.max_entries and len(self.data) > self.max_entries) or
+                    (self.max_bytes and self.bytes > self.max_bytes)):
+
+                    self._pop(next(iter(self.data)))
+                    self.evictions += 1
+
+    def purge(self, test):
+        """ deletes the entries which index matches test() """
+
+        with self.lock:
+            for index in list(self.data.keys()):
+                if test(index):
+                    self._pop(index)
+
+    def invalidate(self, keys):
+        """ deletes the entries built from any of the keys
+            (or from the keys that match keys(), if it's a function) """
+
+        with self.lock:
+            if callable(keys):
+                keys = [k for k in self.rdeps if keys(k)]
+
+            for k in keys:
+                for index in list(self.rdeps.get(k, ())):
+                    self._pop(index)
+
+    def clear(self, force=False):
+        """ clear all entries """
+
+        with self.lock:
+            if force or time.time() > self.rtime + self.ttl:
+                self.data  = OrderedDict()
+                self.rdeps = {}
+                self.bytes = 0
+                self.rtime = time.time()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SharedCache:
+    """ a cache shared by several processes: one file per entry
+        in a folder, ideally in shared memory (i.e. /dev/shm).
+        Entries are touched when used (their mtime is the LRU order)
+        and .deps/<md5 of key>/ holds an empty file named as each entry
+        built from key (plus .key, with the key itself) """
+
+    def __init__(self, path, ttl=3600, max_entries=0, max_bytes=0, sweep=60, deps=None,
+                stale=0):
+        self.path  = path
+        self.ttl   = ttl
+        self.rtime = time.time()
+        self.deps  = deps
+        self.stale = stale
+
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+
+        self.sweep = sweep
+        self.stime = time.time()
+
+        # counters (for this process)
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, index):
+        return "%s/%s" % (self.path, hashlib.md5(str(index).encode()).hexdigest())
+
+    def _deps_folder(self, key):
+        return "%s/.deps/%s" % (self.path, hashlib.md5(key.encode()).hexdigest())
+
+    def _add_deps(self, file, deps):
+        name = os.path.basename(file)
+
+        for k in deps:
+            folder = self._deps_folder(k)
+
+            try:
+                if not os.path.exists(folder + "/.key"):
+                    os.makedirs(folder, exist_ok=True)
+
+                    with open(folder + "/.key", "w") as f:
+                        f.write(k)
+
+                open("%s/%s" % (folder, name), "w").close()
+            except:
+                pass
+
+    def _invalidate_folder(self, folder):
+        """ deletes the entries listed in a deps folder """
+
+        try:
+            names = os.listdir(folder)
+        except:
+            return
+
+        for name in names:
+            if name != ".key":
+                self._unlink("%s/%s" % (self.path, name))
+                self._unlink("%s/%s" % (folder, name))
+
+    def _entries(self):
+        """ iterates (file, stat) of all entries """
+
+        for e in os.scandir(self.path):
+            if e.name[0] != ".":
+                try:
+                    yield e.path, e.stat()
+                except:
+                    pass
+
+    def _read(self, file, header_only=False):
+        """ reads an entry, returning (header, data) or None """
+
+        try:
+            with open(file, "rb") as f:
+                if header_only:
+                    return json.loads(f.readline()), None
+
+                data = f.read()
+
+            h, data = data.split(b"\n", 1)
+
+            return json.loads(h), data
+        except:
+            return None
+
+    def _unlink(self, file):
+        try:
+            os.unlink(file)
+        except:
+            pass
+
+    def _sweep(self):
+        """ deletes expired entries and enforces the limits """
+
+        t = time.time()
+
+        entries = []
+        size    = 0
+
+        for file, st in self._entries():
+            e = self._read(file, header_only=True)
+
+            if e is None or t >= e[0]["expires"] + self.stale:
+                self._unlink(file)
+            else:
+                entries.append((st.st_mtime, st.st_size, file))
+                size += st.st_size
+
+        # evict the least recently used
+        entries.sort()
+
+        while len(entries) > 1 and (
+            (self.max_entries and len(entries) > self.max_entries) or
+            (self.max_bytes and size > self.max_bytes)):
+
+            mtime, s, file = entries.pop(0)
+            self._unlink(file)
+            size -= s
+            self.evictions += 1
+
+        # drop the deps of entries that are gone
+        try:
+            folders = list(os.scandir(self.path + "/.deps"))
+        except:
+            folders = []
+
+        for d in folders:
+            left = 0
+
+            for name in os.listdir(d.path):
+                if name == ".key":
+                    pass
+                elif os.path.exists("%s/%s" % (self.path, name)):
+                    left += 1
+                else:
+                    self._unlink("%s/%s" % (d.path, name))
+
+            if left == 0:
+                shutil.rmtree(d.path, ignore_errors=True)
+
+        self.stime = t
+
+    def get(self, index, tag=""):
+        """ gets an object from a cache """
+
+        object, state, context, stale = self.get_stale(index, tag, False)
 
         return object, state, context
 
-    def put(self, index, object, ttl=120, tag="", context=""):
+    def get_stale(self, index, tag="", accept=True):
+        """ gets an object from a cache, also returning if it's expired
+            (but still within the stale period, if accept is set) """
+
+        object, state, context, stale = None, 0, "", False
+
+        file = self._file(index)
+        e    = self._read(file)
+
+        if e is not None:
+            h, data = e
+            t       = time.time()
+
+            if h["index"] != str(index):
+                # md5 collision (yeah, sure)
+                pass
+
+            elif t < h["expires"] or (accept and t < h["expires"] + self.stale):
+                # cache hit
+                if h["type"] == "bytes":
+                    object = data
+                elif h["type"] == "str":
+                    object = data.decode()
+                else:
+                    object = json.loads(data)
+
+                context = h["context"]
+                state   = 1 if h["tag"] == tag else -1
+                stale   = t >= h["expires"]
+
+                # most recently used
+                try:
+                    os.utime(file)
+                except:
+                    pass
+
+                if self.deps is not None and len(h["deps"]):
+                    self.deps.add(*h["deps"])
+
+            elif t >= h["expires"] + self.stale:
+                # expired
+                self._unlink(file)
+
+        if object is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return object, state, context, stale
+
+    def put(self, index, object, ttl=120, tag="", context="", deps=None):
         """ puts an object into a cache """
 
-        if object is not None:
-            self.data[index] = {
-                "object":   object,
-                "expires":  time.time() + ttl,
-                "tag":      tag,
-                "context":  context
-            }
+        if time.time() > self.stime + self.sweep:
+            self._sweep()
+
+        file = self._file(index)
+
+        if object is None:
+            # un-cache
+            self._unlink(file)
+            return
+
+        if isinstance(object, bytes):
+            type, data = "bytes", object
+        elif isinstance(object, str):
+            type, data = "str", object.encode()
         else:
+            type, data = "json", json.dumps(object).encode()
+
+        h = json.dumps({
+            "index":    str(index),
+            "expires":  time.time() + ttl,
+            "tag":      tag,
+            "context":  context,
+            "type":     type,
+            "deps":     sorted(deps or [])
+        })
+
+        # write and atomically replace
+        tmp = "%s/.%d-%d.tmp" % (self.path, os.getpid(), threading.get_ident())
+
+        try:
+            with open(tmp, "wb") as f:
+                f.write(h.encode() + b"\n" + data)
+
+            os.replace(tmp, file)
+        except:
+            self._unlink(tmp)
+            return
+
+        self._add_deps(file, deps or [])
+
+    def purge(self, test):
+        """ deletes the entries which index matches test() """
+
+        for file, st in self._entries():
+            e = self._read(file, header_only=True)
+
+            if e is not None and test(e[0]["index"]):
+                self._unlink(file)
+
+    def invalidate(self, keys):
+        """ deletes the entries built from any of the keys
+            (or from the keys that match keys(), if it's a function) """
+
+        if callable(keys):
+            test = keys
+            keys = []
+
+            # the keys are not known: test all of them
             try:
-                # un-cache
-                self.data.pop(index)
+                folders = list(os.scandir(self.path + "/.deps"))
             except:
-                pass
+                folders = []
+
+            for d in folders:
+                try:
+                    with open(d.path + "/.key") as f:
+                        if test(f.read()):
+                            self._invalidate_folder(d.path)
+                except:
+                    pass
+
+        for k in keys:
+            self._invalidate_folder(self._deps_folder(k))
 
     def clear(self, force=False):
         """ clear all entries """
 
         if force or time.time() > self.rtime + self.ttl:
-            self.data  = {}
+            for file, st in self._entries():
+                self._unlink(file)
+
+            shutil.rmtree(self.path + "/.deps", ignore_errors=True)
+
             self.rtime = time.time()
+
+    def __len__(self):
+        return len(list(self._entries()))
+
+    @property
+    def bytes(self):
+        return sum([st.st_size for file, st in self._entries()])
@@ -9,6 +9,7 @@
 
 import datetime, re
 import pygruta
+import pygruta.router
 
 
 def events_in_day(s_set, year, month, day):
@@ -270,12 +271,9 @@ def export_icalendar(gruta):
     yield "END:VCALENDAR"
 
 
-def get_handler(gruta, q_path, q_vars):
+@pygruta.router.get(path="/calendar/calendar.ics", ctype="text/calendar; charset=utf-8",
+                    cache=False)
+def icalendar_get_handler(gruta, q_path, q_vars):
     """ calendar GET handler """
 
-    status, body = 0, None
-
-    if q_path == "/calendar/calendar.ics":
-        status, body = 202, "\r\n".join(export_icalendar(gruta))
-
-    return status, body, "text/calendar; charset=utf-8"
+    return 200, "\r\n".join(export_icalendar(gruta))
@@ -12,6 +12,9 @@ import lxml.html
 
 import pygruta
 import pygruta.calendar
+import pygruta.router
+
+HTML_TYPE = "text/html; charset=utf-8"
 
 def links_in_content(content):
     """ Returns all links inside content """
@@ -32,6 +35,8 @@ def header(gruta, nav_headers="", title="", image="", desc=""):
     head, state, context = gruta.html_cache.get("h-head")
 
     if not head:
+        gruta.deps.start()
+
         head = "<!doctype html>\n<html>\n<head>\n"
 
         # css
@@ -61,11 +66,13 @@ def header(gruta, nav_headers="", title="", image="", desc=""):
         head += "<meta name=\"viewport\" content=\"width=device-width, initial-scale=1\"/>\n"
         head += "<meta name=\"generator\" content=\"pygruta\"/>\n"
 
-        gruta.html_cache.put("h-head", head)
+        gruta.html_cache.put("h-head", head, deps=gruta.deps.stop())
 
     header, state, context = gruta.html_cache.get("h-header")
 
     if not header:
+        gruta.deps.start()
+
         header = "<body>\n"
         header += "<header>\n"
         header += "<h1 id=\"title\"><a href=\"%s\">%s</a></h1>\n" % (
@@ -93,7 +100,7 @@ def header(gruta, nav_headers="", title="", image="", desc=""):
 
         header += "<section id=\"main\">\n"
 
-        gruta.html_cache.put("h-header", header)
+        gruta.html_cache.put("h-header", header, deps=gruta.deps.stop())
 
     s = head
     s += "<title>%s: %s</title>\n" % (gruta.template("cfg_site_name"), title)
@@ -120,6 +127,8 @@ def footer(gruta):
     s, state, context = gruta.html_cache.get("h-footer")
 
     if not s:
+        gruta.deps.start()
+
         s = "</section>\n"
 
         t = gruta.template("cfg_copyright")
@@ -129,7 +138,7 @@ def footer(gruta):
 
         s += "</body>\n</html>\n"
 
-        gruta.html_cache.put("h-footer", s)
+        gruta.html_cache.put("h-footer", s, deps=gruta.deps.stop())
 
     return s
 
@@ -144,6 +153,9 @@ def article(gruta, story, content):
     art, state, context = gruta.html_cache.get(i)
 
     if art is None:
+        gruta.deps.start()
+        gruta.deps.add("story:%s/%s" % (topic_id, id))
+
         art = []
 
         # article title
@@ -213,7 +225,7 @@ def article(gruta, story, content):
             gruta.log("INFO", "Render: %s" % gruta.url(story))
             gruta.save_story(story)
 
-        gruta.html_cache.put(i, art)
+        gruta.html_cache.put(i, art, deps=gruta.deps.stop())
 
     return art[0] + content + art[1]
 
@@ -1118,260 +1130,309 @@ def post_user(gruta, p_data):
 
 # handler
 
-def get_handler(gruta, q_path, q_vars):
-    """ HTML get handler """
+@pygruta.router.get(path=("/", "/index.html"), ctype=HTML_TYPE)
+def index_get_handler(gruta, q_path, q_vars):
+    """ INDEX """
 
-    status, body, ctype = 0, None, "text/html; charset=utf-8"
+    status, body = 0, None
 
-    if q_path == "/" or q_path == "/index.html":
-        # INDEX
+    # do info/index exist?
+    story_o = gruta.story("info", "index")
 
-        # do info/index exist?
-        story_o = gruta.story("info", "index")
+    if story_o is not None:
 
-        if story_o is not None:
+        body = header(gruta, title=gruta.template("cfg_slogan"),
+            image=story_o.get("image"))
 
-            body = header(gruta, title=gruta.template("cfg_slogan"),
-                image=story_o.get("image"))
+        body += story_o.get("body")
+        body += footer(gruta)
 
-            body += story_o.get("body")
-            body += footer(gruta)
+        status, body = 200, pygruta.special_uris(gruta, body)
 
-            status, body = 200, pygruta.special_uris(gruta, body)
+    else:
+        offset   = 0
+        num      = int(gruta.template("cfg_index_num"))
+        i_topics = gruta.template("cfg_index_topics").split(":")
+        title    = gruta.template("cfg_slogan")
+        s_set    = list(gruta.story_set(topics=i_topics, offset=offset, num=num + 1))
 
-        else:
-            offset   = 0
-            num      = int(gruta.template("cfg_index_num"))
-            i_topics = gruta.template("cfg_index_topics").split(":")
-            title    = gruta.template("cfg_slogan")
-            s_set    = list(gruta.story_set(topics=i_topics, offset=offset, num=num + 1))
+        status, body = 200, paged_index(gruta, s_set, offset, num, title)
 
-            status, body = 200, paged_index(gruta, s_set, offset, num, title)
+    return status, body
 
 
-    elif re.search("^/~\d+\.html$", q_path):
-        # INDEX with offset
+@pygruta.router.get(pattern=r"^/~\d+\.html$", ctype=HTML_TYPE)
+def index_offset_get_handler(gruta, q_path, q_vars):
+    """ INDEX with offset """
 
-        s        = q_path.replace(".html", "")[2:]
-        offset   = int(s)
-        num      = int(gruta.template("cfg_index_num"))
-        i_topics = gruta.template("cfg_index_topics").split(":")
-        title    = gruta.template("cfg_slogan")
-        s_set    = list(gruta.story_set(topics=i_topics, offset=offset, num=num + 1))
+    status, body = 0, None
 
-        if len(s_set):
-            status, body = 200, paged_index(gruta, s_set, offset, num, title)
+    s        = q_path.replace(".html", "")[2:]
+    offset   = int(s)
+    num      = int(gruta.template("cfg_index_num"))
+    i_topics = gruta.template("cfg_index_topics").split(":")
+    title    = gruta.template("cfg_slogan")
+    s_set    = list(gruta.story_set(topics=i_topics, offset=offset, num=num + 1))
 
+    if len(s_set):
+        status, body = 200, paged_index(gruta, s_set, offset, num, title)
 
-    elif re.search("^/img/.+$", q_path):
-        # Images
-        id = q_path.split("/")[-1]
+    return status, body
 
-        body = gruta.image(id)
 
-        if body is not None:
-            status, ctype = 200, gruta.image_mime_type(id)
-        else:
-            status = 404
+@pygruta.router.get(pattern="^/img/.+$")
+def image_get_handler(gruta, q_path, q_vars):
+    """ Images """
 
+    status, body, ctype = 0, None, None
 
-    elif q_path == "/tag/" or q_path == "/tag/index.html":
-        # TAG list
+    id = q_path.split("/")[-1]
 
-        status, body = 200, tag(gruta)
+    body = gruta.image(id)
 
+    if body is not None:
+        status, ctype = 200, gruta.image_mime_type(id)
+    else:
+        status = 404
 
-    elif re.search("^/tag/.+\.html$", q_path):
-        # TAG
+    return status, body, ctype
 
-        s          = q_path.replace(".html", "")[1:]
-        dummy, t   = s.split("/")
-        s_set      = list(gruta.story_set(tags=[t]))
 
-        if len(s_set):
-            status, body = 200, tag(gruta, t, s_set)
-        else:
-            status = 404
+@pygruta.router.get(path=("/tag/", "/tag/index.html"), ctype=HTML_TYPE)
+def tag_list_get_handler(gruta, q_path, q_vars):
+    """ TAG list """
 
+    return 200, tag(gruta)
 
-    elif re.search("^/user/.+\.html$", q_path):
-        # USER
 
-        s        = q_path.replace(".html", "")[1:]
-        dummy, u = s.split("/")
- 
-        user_o = gruta.user(u)
+@pygruta.router.get(pattern=r"^/tag/.+\.html$", ctype=HTML_TYPE)
+def tag_get_handler(gruta, q_path, q_vars):
+    """ TAG """
 
-        if user_o is not None:
-            status, body = 200, user(gruta, user_o)
-        else:
-            status = 404
+    status, body = 0, None
 
+    s          = q_path.replace(".html", "")[1:]
+    dummy, t   = s.split("/")
+    s_set      = list(gruta.story_set(tags=[t]))
 
-    elif re.search("^/calendar/.*", q_path):
-        # CALENDAR
+    if len(s_set):
+        status, body = 200, tag(gruta, t, s_set)
+    else:
+        status = 404
 
-        a = q_path[1:].split("/")
+    return status, body
 
-        # get year
-        if len(a) == 4:
-            year  = int(a[1])
-            month = int(a[2])
-            day   = int(a[3] or "0")
-        else:
-            year  = None
-            month = None
-            day   = 0
 
-        # get topic list for the calendar
-        topics = gruta.template("cfg_calendar_topics")
+@pygruta.router.get(pattern=r"^/user/.+\.html$", ctype=HTML_TYPE)
+def user_get_handler(gruta, q_path, q_vars):
+    """ USER """
 
-        if topics == "":
-            topics = None
-        else:
-            topics = topics.split(":")
+    status, body = 0, None
 
-        if day == 0:
-            body = calendar_month(gruta, year, month, topics)
-        else:
-            body = calendar_day(gruta, year, month, day, topics)
+    s        = q_path.replace(".html", "")[1:]
+    dummy, u = s.split("/")
 
-        if body is not None:
-            # "202 Accepted" to avoid being cached
-            status = 202
+    user_o = gruta.user(u)
 
+    if user_o is not None:
+        status, body = 200, user(gruta, user_o)
+    else:
+        status = 404
 
-    elif re.search("^/admin/story/.+", q_path):
-        # EDIT_STORY
+    return status, body
 
-        l = q_path[1:].split("/")
 
-        # id is optional for new stories
-        if len(l) == 4:
-            topic_id, id = l[2], l[3]
-        else:
-            topic_id, id = l[2], ""
+@pygruta.router.get(pattern="^/calendar/.*", ctype=HTML_TYPE, cache=False)
+def calendar_get_handler(gruta, q_path, q_vars):
+    """ CALENDAR """
 
-        topic = gruta.topic(topic_id)
+    status, body = 0, None
 
-        if topic is not None:
-            story_o = gruta.story(topic_id, id)
+    a = q_path[1:].split("/")
+
+    # get year
+    if len(a) == 4:
+        year  = int(a[1])
+        month = int(a[2])
+        day   = int(a[3] or "0")
+    else:
+        year  = None
+        month = None
+        day   = 0
 
-            if story_o is None:
-                story_o = gruta.new_story({"topic_id": topic_id, "id": id})
+    # get topic list for the calendar
+    topics = gruta.template("cfg_calendar_topics")
 
-            status, body = 202, edit_story(gruta, story_o, q_vars)
+    if topics == "":
+        topics = None
+    else:
+        topics = topics.split(":")
 
-        else:
-            status = 404
+    if day == 0:
+        body = calendar_month(gruta, year, month, topics)
+    else:
+        body = calendar_day(gruta, year, month, day, topics)
 
+    if body is not None:
+        status = 200
 
-    elif re.search("^/admin/topic/.+", q_path):
-        # EDIT_TOPIC
+    return status, body
 
-        l = q_path[1:].split("/")
 
-        if len(l) == 3:
-            topic_id = l[2]
+@pygruta.router.get(pattern="^/admin/story/.+", ctype=HTML_TYPE, cache=False)
+def edit_story_get_handler(gruta, q_path, q_vars):
+    """ EDIT_STORY """
 
-            topic = gruta.topic(topic_id)
+    status, body = 0, None
 
-            if topic is not None:
-                status, body = 202, edit_topic(gruta, topic)
-            else:
-                status = 404
-        else:
-            status = 404
+    l = q_path[1:].split("/")
+
+    # id is optional for new stories
+    if len(l) == 4:
+        topic_id, id = l[2], l[3]
+    else:
+        topic_id, id = l[2], ""
 
+    topic = gruta.topic(topic_id)
 
-    elif re.search("^/admin/user/.+", q_path):
-        # EDIT_USER
+    if topic is not None:
+        story_o = gruta.story(topic_id, id)
 
-        l = q_path[1:].split("/")
+        if story_o is None:
+            story_o = gruta.new_story({"topic_id": topic_id, "id": id})
 
-        if len(l) == 3:
-            id = l[2]
+        status, body = 200, edit_story(gruta, story_o, q_vars)
 
-            user_o = gruta.user(id)
+    else:
+        status = 404
 
-            if user_o is not None:
-                status, body = 202, edit_user(gruta, user_o)
-            else:
-                status = 404
-        else:
-            status = 404
+    return status, body
 
 
-    elif re.search("^/admin/?$", q_path):
-        # ADMIN
+@pygruta.router.get(pattern="^/admin/topic/.+", ctype=HTML_TYPE, cache=False)
+def edit_topic_get_handler(gruta, q_path, q_vars):
+    """ EDIT_TOPIC """
 
-        status, body = 202, admin(gruta)
+    status, body = 0, None
 
+    l = q_path[1:].split("/")
 
-    elif re.search("^/[^/]+/(index\.html)?$", q_path) or re.search("^/[^/]+/~\d+\.html$", q_path):
-        # TOPIC, with or without offset
+    if len(l) == 3:
+        topic_id = l[2]
 
-        s     = q_path.replace(".html", "")[1:]
-        id, o = s.split("/")
+        topic = gruta.topic(topic_id)
 
-        if o.startswith("~"):
-            o = o.replace("~", "")
+        if topic is not None:
+            status, body = 200, edit_topic(gruta, topic)
         else:
-            o = "0"
+            status = 404
+    else:
+        status = 404
 
-        topic = gruta.topic(id)
+    return status, body
 
-        if topic is not None and (gruta.logged_user or topic.get("internal") != "1"):
-            # visible topic
 
-            private = True if gruta.logged_user else False
+@pygruta.router.get(pattern="^/admin/user/.+", ctype=HTML_TYPE, cache=False)
+def edit_user_get_handler(gruta, q_path, q_vars):
+    """ EDIT_USER """
 
-            offset = int(o)
+    status, body = 0, None
 
-            # first page? test if there is an index story
-            if offset == 0:
-                story_o = gruta.story(id, "index")
-            else:
-                story_o = None
+    l = q_path[1:].split("/")
 
-            if story_o is not None:
-                status, body = 200, story(gruta, story_o)
-            else:
-                num    = int(gruta.template("cfg_topic_num"))
-                title  = topic.get("name")
+    if len(l) == 3:
+        id = l[2]
 
-                # as private can be set to True because there is a logged user,
-                # set d_to to today to avoid showing future stories
-                s_set  = list(gruta.story_set(topics=[id],
-                    offset=offset, num=num + 1, private=private, d_to=gruta.today()))
+        user_o = gruta.user(id)
 
-                if len(s_set):
-                    status, body = 200, paged_index(gruta, s_set, offset, num, title, id)
-                else:
-                    status = 404
+        if user_o is not None:
+            status, body = 200, edit_user(gruta, user_o)
         else:
             status = 404
+    else:
+        status = 404
+
+    return status, body
+
 
+@pygruta.router.get(pattern="^/admin/?$", ctype=HTML_TYPE, cache=False)
+def admin_get_handler(gruta, q_path, q_vars):
+    """ ADMIN """
 
-    elif re.search("^/[^/]+/.+\.html$", q_path):
-        # STORY
+    return 200, admin(gruta)
 
-        s            = q_path.replace(".html", "")[1:]
-        topic_id, id = s.split("/")
-        topic        = gruta.topic(topic_id)
 
-        if topic is not None and topic.get("internal") != "1":
-            story_o = gruta.story(topic_id, id)
+@pygruta.router.get(pattern=r"^/[^/]+/((index\.html)?|~\d+\.html)$", ctype=HTML_TYPE)
+def topic_get_handler(gruta, q_path, q_vars):
+    """ TOPIC, with or without offset """
 
-            if story_o is not None:
-                status, body = 200, story(gruta, story_o)
+    status, body = 0, None
+
+    s     = q_path.replace(".html", "")[1:]
+    id, o = s.split("/")
+
+    if o.startswith("~"):
+        o = o.replace("~", "")
+    else:
+        o = "0"
+
+    topic = gruta.topic(id)
+
+    if topic is not None and (gruta.logged_user or topic.get("internal") != "1"):
+        # visible topic
+
+        private = True if gruta.logged_user else False
+
+        offset = int(o)
+
+        # first page? test if there is an index story
+        if offset == 0:
+            story_o = gruta.story(id, "index")
+        else:
+            story_o = None
+
+        if story_o is not None:
+            status, body = 200, story(gruta, story_o)
+        else:
+            num    = int(gruta.template("cfg_topic_num"))
+            title  = topic.get("name")
+
+            # as private can be set to True because there is a logged user,
+            # set d_to to today to avoid showing future stories
+            s_set  = list(gruta.story_set(topics=[id],
+                offset=offset, num=num + 1, private=private, d_to=gruta.today()))
+
+            if len(s_set):
+                status, body = 200, paged_index(gruta, s_set, offset, num, title, id)
             else:
                 status = 404
+    else:
+        status = 404
+
+    return status, body
+
+
+@pygruta.router.get(pattern=r"^/[^/]+/.+\.html$", ctype=HTML_TYPE)
+def story_get_handler(gruta, q_path, q_vars):
+    """ STORY """
+
+    status, body = 0, None
+
+    s            = q_path.replace(".html", "")[1:]
+    topic_id, id = s.split("/")
+    topic        = gruta.topic(topic_id)
+
+    if topic is not None and topic.get("internal") != "1":
+        story_o = gruta.story(topic_id, id)
+
+        if story_o is not None:
+            status, body = 200, story(gruta, story_o)
         else:
             status = 404
+    else:
+        status = 404
 
-
-    return status, body, ctype
+    return status, body
 
 
 def post_handler(gruta, q_path, q_vars, p_data):
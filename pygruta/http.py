@@ -7,11 +7,17 @@
 
 #   HTTP services
 
+import time
 import pygruta
+import pygruta.metrics
 import urllib3
 
-# PoolManager
-pm = urllib3.PoolManager(retries=urllib3.Retry(total=0, connect=0))
+# PoolManager (keeping some connections per host alive
+# for concurrent requests, i.e. ActivityPub deliveries);
+# a hanging host must not hold a worker forever
+pm = urllib3.PoolManager(num_pools=100, maxsize=8,
+    retries=urllib3.Retry(total=0, connect=0),
+    timeout=urllib3.Timeout(total=60, connect=10, read=30))
 
 def request(method, url, headers={}, fields=None, body=None):
     """ Does an HTTP request """
@@ -21,6 +27,8 @@ def request(method, url, headers={}, fields=None, body=None):
 
     status, data = 500, None
 
+    t = time.perf_counter()
+
     try:
         # why this?
         # request() barfs if both fields and body are set,
@@ -36,4 +44,7 @@ def request(method, url, headers={}, fields=None, body=None):
     except:
         pass
 
+    pygruta.metrics.observe("pygruta_http_client_seconds", time.perf_counter() - t,
+        method=method, status=status)
+
     return status, data
@@ -14,8 +14,18 @@ import time
 import re
 import os
 import hashlib, base64
+import threading, queue, concurrent.futures, selectors
+import gzip
+import email.utils
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 import pygruta
+import pygruta.metrics
+import pygruta.profiler as profiler
 import pygruta.activitypub as activitypub
 import pygruta.webmention as webmention
 import pygruta.calendar as calendar
@@ -23,9 +33,307 @@ import pygruta.xml as xml
 import pygruta.html as html
 import pygruta.text as text
 
+# content encodings, in order of preference
+encoders = [("gzip", lambda b: gzip.compress(b, 6))]
+
+if brotli is not None:
+    encoders.insert(0, ("br", lambda b: brotli.compress(b)))
+
+# smaller bodies are not worth compressing
+compress_min = 256
+
+def compressible(ctype):
+    """ is this content type worth compressing? """
+
+    ctype = (ctype or "text/html").split(";")[0].strip()
+
+    return ctype.startswith("text/") or ctype.endswith(("json", "xml", "javascript"))
+
+
+def variant(q_path, encoding):
+    """ page cache index of a compressed variant """
+
+    return "%s;%s" % (q_path, encoding)
+
+
+def build_page(gruta, q_path, q_vars):
+    """ builds a page and, if successful, stores it into the page cache;
+        returns status, body, ctype, etag and route """
+
+    etag = None
+
+    # record what the page is built from
+    gruta.deps.reset()
+    gruta.deps.start()
+
+    t = time.perf_counter()
+    gruta.local.route = "-"
+
+    # HTTP status of 0 means 'didn't handled it'
+    status, body, ctype = gruta.get_handler(q_path, q_vars)
+
+    route = gruta.local.route
+    pygruta.metrics.observe("pygruta_render_seconds", time.perf_counter() - t,
+        route=route)
+
+    deps = gruta.deps.stop()
+
+    # if successful, put into cache with its validator
+    # (pages have no Last-Modified: templates, topics, users and
+    # story sets, that can lose stories, change without a date)
+    if status == 200:
+        b = body.encode("utf-8") if isinstance(body, str) else body
+
+        # same content, same etag (even after a refill or a restart)
+        etag = "\"%s\"" % hashlib.md5(b).hexdigest()
+
+        context = [ctype, etag, route]
+
+        gruta.page_cache.put(q_path, body, tag=etag, context=context, deps=deps)
+
+        # compressed variants, also built once per render
+        if compressible(ctype) and len(body) >= compress_min:
+            for enc, compress in encoders:
+                gruta.page_cache.put(variant(q_path, enc), compress(b),
+                    tag=etag, context=context, deps=deps)
+        else:
+            for enc, compress in encoders:
+                gruta.page_cache.put(variant(q_path, enc), None)
+
+    return status, body, ctype, etag, route
+
+
+class page_builder:
+    """ builds pages one path at a time (concurrent requests for the same
+        path wait for the first build), and rebuilds the stale ones in
+        a background worker """
+
+    def __init__(self, gruta):
+        self.gruta    = gruta
+        self.cond     = threading.Condition()
+        self.building = set()
+        self.queue    = queue.Queue()
+        self.worker   = None
+
+    def claim(self, q_path):
+        """ claims the build of q_path (returning True; call done() after it)
+            or waits for the build in progress (returning False) """
+
+        with self.cond:
+            if q_path not in self.building:
+                self.building.add(q_path)
+                return True
+
+            while q_path in self.building:
+                self.cond.wait()
+
+        return False
+
+    def done(self, q_path):
+        """ ends the build of q_path """
+
+        with self.cond:
+            self.building.discard(q_path)
+            self.cond.notify_all()
+
+    def refresh(self, q_path, q_vars):
+        """ queues the rebuild of a stale page """
+
+        with self.cond:
+            if q_path not in self.building:
+                self.building.add(q_path)
+                self.queue.put((q_path, q_vars))
+
+                if self.worker is None:
+                    self.worker = threading.Thread(target=self._work, daemon=True)
+                    self.worker.start()
+
+    def _work(self):
+        while True:
+            q_path, q_vars = self.queue.get()
+
+            try:
+                build_page(self.gruta, q_path, q_vars)
+                self.gruta.log("DEBUG", "httpd: REFRESH %s" % q_path)
+
+            except Exception as e:
+                self.gruta.log("ERROR", "httpd: REFRESH %s (%s)" % (q_path, e))
+
+            finally:
+                self.done(q_path)
+
+
+class pool_server(HTTPServer):
+    """ HTTP server that handles requests in a bounded pool of threads;
+        idle persistent connections don't hold one, but are parked
+        until there is more to read from them """
+
+    def __init__(self, address, handler, threads):
+        super().__init__(address, handler)
+
+        self.pool  = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+        # no more new connections being served than threads
+        self.slots = threading.BoundedSemaphore(threads)
+
+        # parked connections: handlers waiting to be registered
+        # into the selector (woken up through a socket pair)
+        self.selector = selectors.DefaultSelector()
+        self.parking  = []
+        self.lock     = threading.Lock()
+        self.closing  = False
+
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+        self.idler = threading.Thread(target=self._idle, daemon=True)
+        self.idler.start()
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        handler = None
+
+        try:
+            handler = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.slots.release()
+
+            if handler is None:
+                self.shutdown_request(request)
+            else:
+                self._park(handler)
+
+    def _resume(self, handler):
+        try:
+            handler.resume()
+        except ConnectionError:
+            # (the client went away)
+            handler.idle = False
+        except Exception:
+            handler.idle = False
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            self._park(handler)
+
+    def _park(self, handler):
+        """ waits (without a thread) for more requests from an idle
+            connection, or closes it; after this, the handler belongs
+            to the selector thread """
+
+        if handler.idle:
+            with self.lock:
+                if not self.closing:
+                    handler.idle_until = time.time() + handler.timeout
+                    self.parking.append(handler)
+                    self.wake_w.send(b"\0")
+                    return
+
+        self._close(handler)
+
+    def _close(self, handler):
+        handler.idle = False
+
+        try:
+            handler.finish()
+        except Exception:
+            pass
+
+        self.shutdown_request(handler.request)
+
+    def _idle(self):
+        """ hands the parked connections back to the pool when they are
+            readable again, and closes them after being idle too long """
+
+        while True:
+            events = self.selector.select(1)
+
+            with self.lock:
+                if self.closing:
+                    break
+
+                parking, self.parking = self.parking, []
+
+            for handler in parking:
+                self.selector.register(handler.request, selectors.EVENT_READ, handler)
+
+            for key, mask in events:
+                if key.fileobj is self.wake_r:
+                    try:
+                        self.wake_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+
+                    continue
+
+                self.selector.unregister(key.fileobj)
+                self.pool.submit(self._resume, key.data)
+
+            t = time.time()
+
+            for key in list(self.selector.get_map().values()):
+                handler = key.data
+
+                if handler is not None and handler.idle_until < t:
+                    self.selector.unregister(key.fileobj)
+                    self._close(handler)
+
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self._close(key.data)
+
+    def server_close(self):
+        with self.lock:
+            self.closing = True
+
+        self.wake_w.send(b"\0")
+        self.idler.join()
+
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
 class httpd_handler(BaseHTTPRequestHandler):
 
-    def _finish(self, status=200, etag=None, ctype=None, body=None):
+    # inotify watcher (if any)
+    watcher = None
+
+    # page builder
+    builder = None
+
+    # only serve from the cache (set missed if it would need a build)
+    cache_only = False
+    missed     = False
+
+    # persistent connections: seconds a connection can be idle
+    # and maximum number of requests served through it
+    # (keep_alive is only set when other clients are not kept waiting)
+    protocol_version = "HTTP/1.1"
+    keep_alive       = True
+    timeout          = 5
+    max_requests     = 100
+    requests         = 0
+
+    # seconds files (images) can be cached by clients
+    file_max_age = 30 * 24 * 60 * 60
+
+    # profiler of the current request (if any)
+    profile = None
+
+    # waiting for more requests in pool_server's selector?
+    idle       = False
+    idle_until = 0
+
+    def _finish(self, status=200, etag=None, ctype=None, body=None, headers=None,
+                file=None):
         if ctype is None:
             ctype = "text/html; charset=utf-8"
 
@@ -38,22 +346,126 @@ class httpd_handler(BaseHTTPRequestHandler):
         if etag:
             self.send_header("ETag", etag)
 
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+
         if status == 303:
             # redirection
             self.send_header("Location", body)
 
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        if file is not None:
+            # (file object, offset, count)
+            self.send_header("Content-Length", str(file[2]))
+        elif status != 304:
+            self.send_header("Content-Length", str(len(body or b"")))
+
+        # enough requests through this connection?
+        self.requests += 1
+
+        if self.requests >= self.max_requests or not self.keep_alive:
+            self.close_connection = True
+
+        if self.close_connection:
+            self.send_header("Connection", "close")
+
         self.end_headers()
 
         if body is not None:
-            if isinstance(body, str):
-                body = body.encode("utf-8")
-
             self.wfile.write(body)
 
-        self.gruta.timed_flush()
+        if file is not None:
+            self._write_file(*file)
+
+        # request metrics
+        route = getattr(self, "route", "-")
+        t0    = getattr(self, "t0", None)
+        dt    = time.perf_counter() - t0 if t0 is not None else 0.0
+
+        pygruta.metrics.inc("pygruta_requests_total",
+            method=self.command, route=route, status=status)
+
+        if t0 is not None:
+            pygruta.metrics.observe("pygruta_request_seconds", dt,
+                route=route, status=status)
+
+        # access log
+        self.gruta.log("INFO", "httpd: CONN %d %s [%s %.1fms]" % (
+            status, self.requestline, route, dt * 1000))
+
+        # (not from the asyncio loop; the server runs it in its pool)
+        if not self.cache_only:
+            self.gruta.timed_flush()
+
+
+    def handle(self):
+        self.close_connection = True
+        self.resume()
+
+    def resume(self):
+        """ handles requests until the connection is closed or idle
+            (if the server can park it to wait for more) """
+
+        self.idle = False
+        self.handle_one_request()
+
+        while not self.close_connection:
+            if isinstance(self.server, pool_server) and self._idle():
+                self.idle = True
+                return
+
+            self.handle_one_request()
+
+    def _idle(self):
+        """ has the client nothing more (already) sent? """
+
+        sock = self.connection
+        sock.setblocking(False)
+
+        try:
+            # (pipelined requests may be waiting in the buffer)
+            return len(self.rfile.peek(1)) == 0
+        except (BlockingIOError, OSError):
+            return True
+        finally:
+            sock.settimeout(self.timeout)
+
+    def finish(self):
+        # idle connections are parked (and finished later) by the server
+        if not self.idle:
+            super().finish()
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            self._end_profile()
+
+
+    def _end_profile(self):
+        if self.profile is not None:
+            profiler.stop(self.profile, self.route)
+            self.profile = None
 
 
     def _init(self):
+        # for metrics
+        self.t0    = time.perf_counter()
+        self.route = "-"
+
+        # admin handlers (and the profiler) check it
+        self.gruta.request_token = self.headers.get("X-Gruta-Token") or ""
+
+        # profile this one?
+        if self.profile is None and not self.cache_only:
+            self.profile = profiler.start(self.gruta, self.headers)
+
+        # apply external modifications
+        if self.watcher is not None:
+            self.watcher.poll()
+
         # parse query string and vars
         qs = self.path.split('?')
         q_path = qs[0]
@@ -66,6 +478,9 @@ class httpd_handler(BaseHTTPRequestHandler):
         else:
             q_vars = {}
 
+        # logged user is per request
+        self.gruta.logged_user = ""
+
         # basic authorization?
         auth = self.headers.get("Authorization")
 
@@ -91,6 +506,128 @@ class httpd_handler(BaseHTTPRequestHandler):
         return self.gruta, q_path, q_vars
 
 
+    def _encoding(self):
+        """ picks a content encoding from Accept-Encoding (or None) """
+
+        accepted = {}
+
+        for e in (self.headers.get("Accept-Encoding") or "").split(","):
+            e = e.split(";")
+            q = 1.0
+
+            for p in e[1:]:
+                p = p.strip()
+
+                if p[0:2] == "q=":
+                    try:
+                        q = float(p[2:])
+                    except:
+                        q = 0.0
+
+            accepted[e[0].strip().lower()] = q
+
+        for enc, compress in encoders:
+            if accepted.get(enc, accepted.get("*", 0.0)) > 0.0:
+                return enc
+
+        return None
+
+
+    def _send_file(self, file, ctype):
+        """ sends a file, honoring conditional and Range requests """
+
+        st    = os.stat(file)
+        size  = st.st_size
+        etag  = "\"%x-%x\"" % (st.st_mtime_ns, size)
+        l_mod = email.utils.formatdate(st.st_mtime, usegmt=True)
+
+        headers = {
+            "Last-Modified":    l_mod,
+            "Accept-Ranges":    "bytes",
+            "Cache-Control":    "public, max-age=%d" % self.file_max_age
+        }
+
+        if self._not_modified(etag, l_mod):
+            self._finish(304, etag, ctype, None, headers)
+            return
+
+        status, offset, count = 200, 0, size
+
+        rng = self.headers.get("Range")
+        ifr = self.headers.get("If-Range")
+
+        # only ranges of the current version
+        if rng is not None and ifr is not None and ifr != etag and ifr != l_mod:
+            rng = None
+
+        if rng is not None:
+            x = re.search(r"^bytes=(\d*)-(\d*)$", rng.strip())
+
+            # a range that ends before it starts is invalid: ignored
+            if x is not None and x.group(1) and x.group(2):
+                if int(x.group(1)) > int(x.group(2)):
+                    x = None
+
+            if x is not None and (x.group(1) or x.group(2)):
+                if x.group(1):
+                    first = int(x.group(1))
+                    last  = int(x.group(2)) if x.group(2) else size - 1
+                else:
+                    # suffix: the last N bytes
+                    first = max(size - int(x.group(2)), 0)
+                    last  = size - 1
+
+                last = min(last, size - 1)
+
+                if first > last:
+                    headers["Content-Range"] = "bytes */%d" % size
+                    self._finish(416, None, "text/html", "<h1>416 Range Not Satisfiable</h1>",
+                        headers)
+                    return
+
+                status, offset, count = 206, first, last - first + 1
+                headers["Content-Range"] = "bytes %d-%d/%d" % (first, last, size)
+
+        with open(file, "rb") as f:
+            self._finish(status, etag, ctype, None, headers, (f, offset, count))
+
+
+    def _not_modified(self, etag, l_mod=None):
+        """ does the client already have this version? """
+
+        inm = self.headers.get("If-None-Match")
+
+        if inm is not None:
+            for t in inm.split(","):
+                t = t.strip()
+
+                if t == "*":
+                    return True
+
+                if t[0:2] == "W/":
+                    t = t[2:]
+
+                # compressed variants have the encoding appended
+                for enc, compress in encoders:
+                    t = t.replace("-%s\"" % enc, "\"")
+
+                if t == etag:
+                    return True
+
+            return False
+
+        ims = self.headers.get("If-Modified-Since")
+
+        if ims is not None and l_mod is not None:
+            try:
+                return (email.utils.parsedate_to_datetime(ims) >=
+                        email.utils.parsedate_to_datetime(l_mod))
+            except:
+                pass
+
+        return False
+
+
     def _invalid_token(self, gruta):
         ret = False
 
@@ -114,28 +651,53 @@ class httpd_handler(BaseHTTPRequestHandler):
     def do_GET(self):
         gruta, q_path, q_vars = self._init()
 
-        # get time and new and old tags
-        time_n = time.time()
-        etag_n = None
-        etag_o = self.headers.get("If-None-Match") or ""
+        # images stored as files are sent as is
+        if q_path.startswith("/img/") and not self._invalid_token(gruta):
+            id   = q_path[5:]
+            file = gruta.image_file(id)
 
-        # try the cache
-        body, state, ctype = gruta.page_cache.get(q_path, etag_o)
+            if file is not None:
+                if self.cache_only:
+                    # (reading files is not for the event loop)
+                    self.missed = True
+                else:
+                    self.route = "image_file"
+                    self._send_file(file, gruta.image_mime_type(id) or
+                        "application/octet-stream")
+                return
 
-        # not yet? build it
-        if body is None:
-            # HTTP status of 0 means 'didn't handled it'
+        etag = None
 
-            if self._invalid_token(gruta):
-                status, body, ctype = 401, "<h1>401 Auth Required</h1>", "text/html"
-            else:
-                status, body, ctype = gruta.get_handler(q_path, q_vars)
+        # try the cache (expired entries may still be served while rebuilt)
+        body, state, context, stale = gruta.page_cache.get_stale(q_path)
+
+        if body is not None and stale:
+            self.builder.refresh(q_path, q_vars)
+
+        if body is None and self.cache_only:
+            self.missed = True
+            return
+
+        claimed = False
 
-            # if successful, put into cache and create new etag
-            if status == 200:
-                etag_n = "W/\"g-%x\"" % int(time_n)
+        if body is None:
+            claimed = self.builder.claim(q_path)
+
+            if not claimed:
+                # somebody else has just built it
+                body, state, context, stale = gruta.page_cache.get_stale(q_path)
 
-                gruta.page_cache.put(q_path, body, tag=etag_n, context=ctype)
+        # not yet? build it
+        if body is None:
+            try:
+                if self._invalid_token(gruta):
+                    status, body, ctype = 401, "<h1>401 Auth Required</h1>", "text/html"
+                else:
+                    status, body, ctype, etag, self.route = build_page(
+                        gruta, q_path, q_vars)
+            finally:
+                if claimed:
+                    self.builder.done(q_path)
 
             # nobody handled this? notify error
             if status == 0:
@@ -146,14 +708,41 @@ class httpd_handler(BaseHTTPRequestHandler):
                 status, body, ctype = 404, "<h1>404 Not Found</h1>", "text/html"
 
         else:
-            if state == 1:
-                # client already has it
-                status, body = 304, None
-            else:
-                # serve client the cached state
-                status = 200
+            # serve client the cached state
+            status = 200
+            ctype, etag, self.route = context
+
+        # client already has it?
+        if status == 200 and self._not_modified(etag):
+            status = 304
+
+        headers = {}
+
+        # story page? count a hit
+        if status == 200 or status == 304:
+            x = re.search(r"^/([^/]+)/([^/~]+)\.html$", q_path)
+
+            if x is not None and x.group(1) not in ("tag", "user") and x.group(2) != "index":
+                gruta.hit(x.group(1), x.group(2))
+
+        # send a compressed variant, if the client accepts it
+        if (status == 200 or status == 304) and compressible(ctype):
+            headers["Vary"] = "Accept-Encoding"
+
+            enc = self._encoding()
+
+            if enc is not None:
+                c_body = gruta.page_cache.get_stale(variant(q_path, enc))[0]
 
-        self._finish(status, etag_n, ctype, body)
+                if c_body is not None:
+                    body = c_body
+                    etag = "%s-%s\"" % (etag[0:-1], enc)
+                    headers["Content-Encoding"] = enc
+
+        if status == 304:
+            body = None
+
+        self._finish(status, etag, ctype, body, headers)
 
 
     def do_POST(self):
@@ -170,14 +759,17 @@ class httpd_handler(BaseHTTPRequestHandler):
             status, body, ctype = 401, "<h1>401 Auth Required</h1>", "text/html"
 
         elif re.search("^/activitypub/inbox/.+", q_path):
+            self.route = "inbox_post_handler"
             status, body, ctype = activitypub.inbox_post_handler(gruta, q_path,
                 q_vars, p_data)
 
         elif q_path == "/webmention/" or q_path == "/post_webmention/":
+            self.route = "webmention_post_handler"
             status, body, ctype = webmention.post_handler(
                                     gruta, urllib.parse.parse_qs(p_data))
 
         else:
+            self.route = "html_post_handler"
             status, body, ctype = html.post_handler(gruta, q_path, q_vars,
                 urllib.parse.parse_qs(p_data))
 
@@ -188,10 +780,46 @@ class httpd_handler(BaseHTTPRequestHandler):
         self._finish(status, None, ctype, body)
 
 
+    def _write_file(self, f, offset, count):
+        """ sends count bytes of a file from offset as the body """
+
+        # zero-copy (if the OS allows it)
+        self.wfile.flush()
+        self.connection.sendfile(f, offset, count)
+
+    def log_request(self, code="-", size="-"):
+        # requests are logged by _finish()
+        pass
+
+
     def log_message(self, format, *args):
-        gruta, q_path, q_vars = self._init()
-        gruta.log("INFO", "httpd: CONN %s %s" % (args[1], args[0]))
+        self.gruta.log("INFO", "httpd: " + (format % args))
+
+
+
+def setup_handler(handler, gruta):
+    """ prepares a handler class to serve gruta """
+
+    # copy the gruta object into the handler
+    handler.gruta = gruta
+
+    handler.builder = page_builder(gruta)
+
+    # persistent connections
+    try:
+        handler.timeout = int(gruta.template("cfg_httpd_timeout") or handler.timeout)
+        handler.max_requests = int(gruta.template("cfg_httpd_max_requests") or
+            handler.max_requests)
+    except:
+        pass
+
+    # resume the processing of queued inbox messages
+    activitypub.inbox_queue(gruta)
 
+    # watch FS sources edited out-of-band?
+    if gruta.template("cfg_inotify") == "1":
+        import pygruta.inotify as inotify
+        handler.watcher = inotify.watch(gruta)
 
 
 def httpd(gruta, address="localhost", port=8000):
@@ -206,12 +834,30 @@ def httpd(gruta, address="localhost", port=8000):
 
     signal.signal(signal.SIGTERM, sigterm_handler)
 
-    server = HTTPServer((address, port), httpd_handler)
+    # asyncio engine?
+    if gruta.template("cfg_httpd_engine") == "asyncio":
+        import pygruta.ahttpd as ahttpd
+        return ahttpd.ahttpd(gruta, address, port)
+
+    # number of threads (0, serve one request at a time)
+    try:
+        threads = int(gruta.template("cfg_httpd_threads") or "0")
+    except:
+        threads = 0
+
+    if threads > 0:
+        server = pool_server((address, port), httpd_handler, threads)
+    else:
+        server = HTTPServer((address, port), httpd_handler)
+
+        # an idle persistent connection would block everybody else
+        httpd_handler.keep_alive = False
+
     gruta.log("INFO",
-        "httpd: START %s:%s [pygruta %s]" % (address, port, pygruta.__version__))
+        "httpd: START %s:%s [pygruta %s, %d threads]" % (address, port,
+        pygruta.__version__, threads))
 
-    # copy the gruta object into the handler
-    server.RequestHandlerClass.gruta = gruta
+    setup_handler(server.RequestHandlerClass, gruta)
 
     try:
         server.serve_forever()
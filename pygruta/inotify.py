@@ -0,0 +1,153 @@
+#
+#   pygruta CMS
+#   ttcdt <dev@triptico.com>
+#
+#   This software is released into the public domain.
+#
+
+#   inotify-driven cache invalidation for FS sources (Linux only)
+
+import os, struct, ctypes, ctypes.util
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0x00000800
+IN_CLOEXEC     = 0x00080000
+
+MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+class Watcher:
+    def __init__(self, gruta, path):
+        self.gruta = gruta
+        self.path  = path
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+            use_errno=True)
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+        # watch descriptor -> folder (relative to path)
+        self.wds = {}
+
+        for d in ("topics", "users", "followers", "templates", "images"):
+            self._add(d)
+
+        for d in ("topics", "followers"):
+            try:
+                for e in os.scandir("%s/%s" % (path, d)):
+                    if e.is_dir():
+                        self._add("%s/%s" % (d, e.name))
+            except FileNotFoundError:
+                pass
+
+    def _add(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd,
+            ("%s/%s" % (self.path, folder)).encode(), MASK)
+
+        if wd >= 0:
+            self.wds[wd] = folder
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def poll(self):
+        """ processes the pending events (never blocks) """
+
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            off = 0
+
+            while off < len(buf):
+                wd, mask, cookie, l = struct.unpack_from("iIII", buf, off)
+                off += 16
+
+                name = buf[off:off + l].rstrip(b"\0").decode(errors="replace")
+                off += l
+
+                if mask & IN_IGNORED:
+                    self.wds.pop(wd, None)
+
+                elif wd in self.wds:
+                    self.event(self.wds[wd], name, mask)
+
+    def event(self, folder, name, mask):
+        """ invalidates the cached data affected by a changed file """
+
+        gruta = self.gruta
+
+        if folder in ("topics", "followers") and mask & IN_ISDIR:
+            # new topic or user followers folder: watch it
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add("%s/%s" % (folder, name))
+
+                # (it may have been written into before being watched)
+                if folder == "followers":
+                    gruta.invalidate("followers", name)
+
+        elif folder == "topics":
+            if name == ".INDEX":
+                gruta.invalidate("index")
+
+            elif name.endswith(".M"):
+                gruta.invalidate("topic", name[0:-2])
+
+        elif folder.startswith("topics/"):
+            # story files; .H files only hold hits
+            if name[0] != "." and not name.endswith(".H"):
+                id = name.split(".")[0]
+
+                gruta.invalidate("story", id, folder.split("/")[1])
+
+        elif folder.startswith("followers/"):
+            # follower files, or their manifest
+            if name[0] != "." or name == ".INDEX":
+                gruta.invalidate("followers", folder.split("/")[1])
+
+        elif folder == "followers":
+            pass
+
+        elif name[0] != ".":
+            # users, templates or images
+            gruta.invalidate(folder[0:-1], name)
+
+        gruta.log("DEBUG", "inotify: %s/%s (%x)" % (folder, name, mask))
+
+
+def watch(gruta):
+    """ returns a Watcher for gruta (None if it can't be watched) """
+
+    import pygruta.FS
+    import pygruta.Cached
+
+    source = gruta.source if isinstance(gruta, pygruta.Cached.Cached) else gruta
+
+    if not isinstance(source, pygruta.FS.FS):
+        return None
+
+    try:
+        w = Watcher(gruta, source.path)
+    except Exception as e:
+        gruta.log("WARN", "inotify: cannot watch %s (%s)" % (source.path, e))
+        w = None
+
+    if w is not None and source is not gruta:
+        # changes arrive as events; stop polling the FS
+        gruta.check_interval = None
+
+    return w
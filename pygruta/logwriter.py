@@ -0,0 +1,100 @@
+#
+#   pygruta CMS
+#   ttcdt <dev@triptico.com>
+#
+#   This software is released into the public domain.
+#
+
+#   buffered log file writer
+
+import threading, queue, datetime, atexit
+
+class LogWriter:
+    """ writes log lines to a file from a background thread; the file
+        name can be strftime()-tagged (i.e. pygruta-%Y%m%d.log) and
+        is reopened when it changes """
+
+    def __init__(self, pattern, max_queue=10000, max_batch=256):
+        self.pattern   = pattern
+        self.queue     = queue.Queue(max_queue)
+        self.max_batch = max_batch
+
+        self.name = None
+        self.file = None
+
+        # lines lost because the queue was full
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+        # don't lose the pending lines on exit
+        atexit.register(self.close)
+
+    def write(self, line):
+        """ queues a line (never blocks) """
+
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """ writes the pending lines and closes the file """
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _open(self):
+        name = datetime.datetime.now().strftime(self.pattern)
+
+        if name != self.name:
+            if self.file is not None:
+                self.file.close()
+
+            try:
+                self.file = open(name, "a")
+            except:
+                self.file = None
+
+            self.name = name
+
+    def _run(self):
+        done = False
+
+        while not done:
+            batch = [self.queue.get()]
+
+            # take what is waiting
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                done  = True
+                batch = [l for l in batch if l is not None]
+
+            if len(batch) == 0:
+                continue
+
+            # new day (or whatever the pattern says)?
+            self._open()
+
+            if self.file is not None:
+                try:
+                    self.file.write("".join([l + "\n" for l in batch]))
+
+                    if self.dropped:
+                        self.file.write("WARN : %d log lines dropped\n" % self.dropped)
+                        self.dropped = 0
+
+                    self.file.flush()
+                except:
+                    pass
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
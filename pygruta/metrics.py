@@ -0,0 +1,110 @@
+#
+#   pygruta CMS
+#   ttcdt <dev@triptico.com>
+#
+#   This software is released into the public domain.
+#
+
+#   process metrics (Prometheus text format)
+
+import threading
+
+# histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+lock = threading.Lock()
+
+# (name, labels) -> value
+counters = {}
+
+# (name, labels) -> [count per bucket..., sum, count]
+histograms = {}
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, n=1, **labels):
+    """ increments a counter """
+
+    k = (name, _labels(labels))
+
+    with lock:
+        counters[k] = counters.get(k, 0) + n
+
+
+def observe(name, value, **labels):
+    """ adds a value (i.e. a duration) to a histogram """
+
+    k = (name, _labels(labels))
+
+    with lock:
+        h = histograms.get(k)
+
+        if h is None:
+            h = histograms[k] = [0] * (len(BUCKETS) + 2)
+
+        for i, b in enumerate(BUCKETS):
+            if value <= b:
+                h[i] += 1
+                break
+
+        h[-2] += value
+        h[-1] += 1
+
+
+def _fmt(labels, extra=()):
+    l = list(labels) + list(extra)
+
+    if len(l) == 0:
+        return ""
+
+    return "{%s}" % ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\")
+        .replace('"', '\\"')) for k, v in l])
+
+
+def render(gauges={}, totals={}):
+    """ returns all metrics in Prometheus text format
+        (plus the gauges and totals, dicts of name -> value;
+        names can include labels, i.e. 'x{cache="page"}') """
+
+    with lock:
+        c = sorted(counters.items())
+        h = sorted([(k, list(v)) for k, v in histograms.items()])
+
+    out  = []
+    seen = set()
+
+    for type, d in (("gauge", gauges), ("counter", totals)):
+        for name, v in sorted(d.items()):
+            n = name.split("{")[0]
+
+            if n not in seen:
+                out.append("# TYPE %s %s" % (n, type))
+                seen.add(n)
+
+            out.append("%s %s" % (name, v))
+
+    for (name, labels), v in c:
+        if name not in seen:
+            out.append("# TYPE %s counter" % name)
+            seen.add(name)
+
+        out.append("%s%s %s" % (name, _fmt(labels), v))
+
+    for (name, labels), v in h:
+        if name not in seen:
+            out.append("# TYPE %s histogram" % name)
+            seen.add(name)
+
+        acc = 0
+
+        for i, b in enumerate(BUCKETS):
+            acc += v[i]
+            out.append("%s_bucket%s %d" % (name, _fmt(labels, [("le", b)]), acc))
+
+        out.append("%s_bucket%s %d" % (name, _fmt(labels, [("le", "+Inf")]), v[-1]))
+        out.append("%s_sum%s %f" % (name, _fmt(labels), v[-2]))
+        out.append("%s_count%s %d" % (name, _fmt(labels), v[-1]))
+
+    return "\n".join(out) + "\n"
@@ -0,0 +1,136 @@
+#
+#   pygruta CMS
+#   ttcdt <dev@triptico.com>
+#
+#   This software is released into the public domain.
+#
+
+#   sampling profiler for httpd requests
+
+import cProfile, pstats
+import threading, random, time, io, os, re
+
+import pygruta.router
+
+# only one profiler can be running at a time
+running = threading.Lock()
+
+# route -> pstats.Stats
+lock  = threading.Lock()
+stats = {}
+
+# configuration (re-read from templates every config_ttl seconds)
+config_ttl  = 30
+config_time = 0
+rate        = 0.0
+folder      = ""
+
+def _config(gruta):
+    global config_time, rate, folder
+
+    if time.time() > config_time + config_ttl:
+        try:
+            rate = float(gruta.template("cfg_profile_rate") or "0")
+        except:
+            rate = 0.0
+
+        folder = gruta.template("cfg_profile_dir")
+        config_time = time.time()
+
+
+def start(gruta, headers):
+    """ starts profiling a request if it's sampled or asked for
+        (with X-Gruta-Profile and the admin X-Gruta-Token);
+        returns a profiler to be stopped with stop(), or None """
+
+    _config(gruta)
+
+    asked = False
+
+    if headers.get("X-Gruta-Profile"):
+        asked = gruta.admin_request()
+
+    if not asked and (rate <= 0.0 or random.random() >= rate):
+        return None
+
+    # somebody else being profiled? skip
+    if not running.acquire(blocking=False):
+        return None
+
+    p = cProfile.Profile()
+    p.enable()
+
+    return p
+
+
+def stop(p, route):
+    """ stops a profiler and adds its data to the route's """
+
+    p.disable()
+    running.release()
+
+    with lock:
+        s = stats.get(route)
+
+        if s is None:
+            s = stats[route] = pstats.Stats(p)
+        else:
+            s.add(p)
+
+        # loadable with pstats.Stats(file)
+        if folder != "":
+            try:
+                os.makedirs(folder, exist_ok=True)
+                s.dump_stats("%s/%s.pstats" % (folder, re.sub(r"[^\w.-]", "_", route)))
+            except:
+                pass
+
+
+def top(route=None, n=20, sort="cumulative"):
+    """ returns the top n functions of a route (or of all of them) """
+
+    out = io.StringIO()
+
+    with lock:
+        if route is not None:
+            l = [stats[route]] if route in stats else []
+        else:
+            l = list(stats.values())
+
+        if len(l):
+            s = pstats.Stats(stream=out)
+            s.add(*l)
+            s.sort_stats(sort).print_stats(n)
+        else:
+            out.write("no data\n")
+
+    return out.getvalue()
+
+
+@pygruta.router.get(path="/admin/profile.txt", ctype="text/plain; charset=utf-8",
+                    cache=False)
+def profile_get_handler(gruta, q_path, q_vars):
+    """ top functions (?route=...&n=...&sort=...) """
+
+    # only for those with the admin token
+    if not gruta.admin_request():
+        return 404, None
+
+    route = q_vars.get("route", [None])[0]
+    sort  = q_vars.get("sort", ["cumulative"])[0]
+
+    try:
+        n = int(q_vars.get("n", ["20"])[0])
+    except:
+        n = 20
+
+    with lock:
+        body = "routes: %s\n\n" % " ".join(
+            ["%s" % r for r in sorted(stats.keys())])
+
+    try:
+        body += top(route, n, sort)
+    except KeyError:
+        body += "bad sort key '%s'\n" % sort
+
+    return 200, body
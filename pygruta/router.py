@@ -0,0 +1,122 @@
+#
+#   pygruta CMS
+#   ttcdt <dev@triptico.com>
+#
+#   This software is released into the public domain.
+#
+
+#   GET request routing
+
+import re
+
+class Route:
+    def __init__(self, handler, prefix=None, pattern=None, ctype=None, cache=True):
+        self.handler = handler
+        self.prefix  = prefix
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        self.ctype   = ctype
+        self.cache   = cache
+        self.name    = handler.__name__
+
+    def match(self, q_path):
+        if self.prefix is not None:
+            return q_path.startswith(self.prefix)
+
+        if self.pattern is not None:
+            return self.pattern.search(q_path) is not None
+
+        # exact routes are matched by the router
+        return True
+
+    def call(self, gruta, q_path, q_vars):
+        """ calls the handler; returns status, body and ctype """
+
+        ret = self.handler(gruta, q_path, q_vars)
+
+        # handlers can return their own content type
+        status, body = ret[0], ret[1]
+        ctype = ret[2] if len(ret) > 2 and ret[2] is not None else self.ctype
+
+        # "202 Accepted" to avoid being cached
+        if status == 200 and not self.cache:
+            status = 202
+
+        return status, body, ctype
+
+
+class Router:
+    def __init__(self):
+        # path -> routes
+        self.exact   = {}
+
+        # first path component -> prefix and pattern routes
+        self.segment = {}
+
+        # the rest of pattern routes
+        self.generic = []
+
+    def add(self, handler, path=None, prefix=None, pattern=None, ctype=None, cache=True):
+        """ adds a route (an exact path or tuple of paths, a prefix or a regex) """
+
+        r = Route(handler, prefix=prefix, pattern=pattern, ctype=ctype, cache=cache)
+
+        if path is not None:
+            for p in (path,) if isinstance(path, str) else path:
+                self.exact.setdefault(p, []).append(r)
+
+        else:
+            # starting with a literal folder?
+            x = re.search(r"^\^?/([\w.-]+)/", prefix or pattern)
+
+            if x is not None:
+                self.segment.setdefault(x.group(1), []).append(r)
+            else:
+                self.generic.append(r)
+
+        return r
+
+    def routes(self, q_path):
+        """ iterates the routes that match q_path, in order """
+
+        for r in self.exact.get(q_path, []):
+            yield r
+
+        s = q_path.split("/")
+
+        if len(s) > 1:
+            for r in self.segment.get(s[1], []):
+                if r.match(q_path):
+                    yield r
+
+        for r in self.generic:
+            if r.match(q_path):
+                yield r
+
+    def dispatch(self, gruta, q_path, q_vars):
+        """ calls the first route that handles q_path
+            (a status of 0 means not handled) """
+
+        for r in self.routes(q_path):
+            status, body, ctype = r.call(gruta, q_path, q_vars)
+
+            if status != 0:
+                # (for metrics)
+                gruta.local.route = r.name
+
+                return status, body, ctype
+
+        return 0, None, None
+
+
+# the GET routes
+routes = Router()
+
+def get(path=None, prefix=None, pattern=None, ctype=None, cache=True):
+    """ decorator that adds a GET handler to the routes """
+
+    def f(handler):
+        routes.add(handler, path=path, prefix=prefix, pattern=pattern,
+            ctype=ctype, cache=cache)
+        return handler
+
+    return f
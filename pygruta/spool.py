@@ -0,0 +1,217 @@
+#
+#   pygruta CMS
+#   ttcdt <dev@triptico.com>
+#
+#   This software is released into the public domain.
+#
+
+#   durable work queue
+
+import os, json, time, threading
+
+class Spool:
+    """ a work queue that survives restarts: one file per item in a folder,
+        processed by a pool of worker threads (no more than per_key of them
+        on items with the same key, i.e. a remote host, at a time);
+        several processes can share the folder, as items are claimed
+        (renamed to <id>.<pid>.work) before being processed """
+
+    def __init__(self, path, process, workers=4, per_key=2, retries=5, delay=60,
+                 log=None):
+        self.path    = path
+        self.process = process
+        self.workers = workers
+        self.per_key = per_key
+        self.retries = retries
+        self.delay   = delay
+        self.log     = log or (lambda category, string: None)
+
+        self.cond    = threading.Condition()
+
+        # [next try time, file, key], in arrival order
+        self.pending = []
+
+        # key -> items being processed
+        self.running = {}
+
+        self.threads = []
+
+        os.makedirs(path, exist_ok=True)
+
+    def _write(self, file, e):
+        tmp = "%s/.%d-%d.tmp" % (self.path, os.getpid(), threading.get_ident())
+
+        with open(tmp, "w") as f:
+            json.dump(e, f)
+
+        os.replace(tmp, file)
+
+    def _read(self, file):
+        try:
+            with open(file) as f:
+                return json.load(f)
+        except:
+            return None
+
+    def _unlink(self, file):
+        try:
+            os.unlink(file)
+        except:
+            pass
+
+    def _alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+
+        return True
+
+    def _claim(self, file):
+        """ takes an item for this process; returns the claimed
+            file name, or None if another process took it before """
+
+        work = "%s.%d.work" % (file[0:-5], os.getpid())
+
+        try:
+            os.rename(file, work)
+        except FileNotFoundError:
+            return None
+
+        return work
+
+    def start(self):
+        """ queues the items left by a previous run and starts the workers """
+
+        with self.cond:
+            if len(self.threads):
+                return
+
+            # items claimed by processes that are gone are queued again
+            for name in os.listdir(self.path):
+                if name.endswith(".work"):
+                    id, pid = name[0:-5].rsplit(".", 1)
+
+                    if not self._alive(int(pid)):
+                        try:
+                            os.rename("%s/%s" % (self.path, name),
+                                "%s/%s.json" % (self.path, id))
+                        except FileNotFoundError:
+                            pass
+
+            for name in sorted(os.listdir(self.path)):
+                if name.endswith(".json"):
+                    file = "%s/%s" % (self.path, name)
+                    e    = self._read(file)
+
+                    if e is not None:
+                        self.pending.append([e["next"], file, e["key"]])
+
+            if len(self.pending):
+                self.log("INFO", "spool: %s: %d pending items" % (
+                    self.path, len(self.pending)))
+
+            for n in range(self.workers):
+                t = threading.Thread(target=self._work, daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def put(self, item, key=""):
+        """ stores an item and queues it for processing """
+
+        # names sort by arrival
+        file = "%s/%d-%d-%d.json" % (self.path, time.time_ns(), os.getpid(),
+            threading.get_ident())
+
+        self._write(file, {"key": key, "tries": 0, "next": 0, "item": item})
+
+        with self.cond:
+            self.pending.append([0, file, key])
+            self.cond.notify()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.pending) + sum(self.running.values())
+
+    def _next(self):
+        """ waits for an item that is due and which key is not busy """
+
+        with self.cond:
+            while True:
+                t    = time.time()
+                wait = None
+
+                for i, (next, file, key) in enumerate(self.pending):
+                    if self.running.get(key, 0) >= self.per_key:
+                        continue
+
+                    if next <= t:
+                        del self.pending[i]
+                        self.running[key] = self.running.get(key, 0) + 1
+                        return file, key
+
+                    if wait is None or next - t < wait:
+                        wait = next - t
+
+                self.cond.wait(wait)
+
+    def _done(self, key):
+        with self.cond:
+            self.running[key] -= 1
+
+            if self.running[key] == 0:
+                del self.running[key]
+
+            self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            file, key = self._next()
+
+            try:
+                work = self._claim(file)
+
+                if work is None:
+                    continue
+
+                e = self._read(work)
+
+                if e is None:
+                    self.log("ERROR", "spool: %s: unreadable" % file)
+                    os.replace(work, file + ".failed")
+                    continue
+
+                try:
+                    ok = self.process(e["item"])
+                except Exception as ex:
+                    self.log("ERROR", "spool: %s: %s" % (file, ex))
+                    ok = False
+
+                if ok:
+                    self._unlink(work)
+
+                elif e["tries"] >= self.retries:
+                    self.log("ERROR", "spool: %s: giving up after %d tries" % (
+                        file, e["tries"] + 1))
+
+                    # kept for inspection, but never retried
+                    os.replace(work, file + ".failed")
+
+                else:
+                    # try again later (exponential backoff)
+                    e["tries"] += 1
+                    e["next"]   = time.time() + self.delay * 2 ** (e["tries"] - 1)
+
+                    self._write(file, e)
+                    self._unlink(work)
+
+                    with self.cond:
+                        self.pending.append([e["next"], file, key])
+
+            except Exception as ex:
+                self.log("ERROR", "spool: %s: %s" % (file, ex))
+
+            finally:
+                self._done(key)
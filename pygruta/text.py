@@ -9,35 +9,65 @@
 
 import re
 import pygruta
+import pygruta.router
+import pygruta.metrics
 
-def get_handler(gruta, q_path, q_vars):
-    """ GET handler for .txt files """
+TEXT_TYPE = "text/plain; charset=utf-8"
 
-    status, body, ctype = 0, None, "text/plain; charset=utf-8"
+@pygruta.router.get(path="/admin/status.txt", ctype=TEXT_TYPE, cache=False)
+def status_get_handler(gruta, q_path, q_vars):
+    """ version and cache statistics """
 
-    if q_path == "/admin/status.txt":
-        status = 202
-        body   = ""
+    body = ""
 
-        body += "version: %s\n" % pygruta.__version__
-        body += "id: %s\n" % gruta.id()
-        body += "html-cache-entries: %d\n" % len(gruta.html_cache.data)
-        body += "page-cache-entries: %d\n" % len(gruta.page_cache.data)
+    body += "version: %s\n" % pygruta.__version__
+    body += "id: %s\n" % gruta.id()
+    for n, c in (("html", gruta.html_cache), ("page", gruta.page_cache)):
+        body += "%s-cache-entries: %d\n" % (n, len(c))
+        body += "%s-cache-bytes: %d\n" % (n, c.bytes)
+        body += "%s-cache-hits: %d\n" % (n, c.hits)
+        body += "%s-cache-misses: %d\n" % (n, c.misses)
+        body += "%s-cache-evictions: %d\n" % (n, c.evictions)
 
-    elif q_path == "/robots.txt":
-        status = 200
-        body   = gruta.template("robots_txt")
+    return 200, body
 
-    elif q_path == "/twtxt.txt":
-        status = 200
-        body   = twtxt(gruta, gruta.feed())
 
-    elif q_path == "/style.css":
-        status = 200
-        body   = gruta.template("css_compact")
-        ctype  = "text/css"
+@pygruta.router.get(path="/admin/metrics", ctype="text/plain; version=0.0.4; charset=utf-8",
+                    cache=False)
+def metrics_get_handler(gruta, q_path, q_vars):
+    """ Prometheus metrics """
 
-    return status, body, ctype
+    # only for those with the admin token
+    if not gruta.admin_request():
+        return 404, None
+
+    gauges, totals = {}, {}
+
+    for n, c in (("html", gruta.html_cache), ("page", gruta.page_cache)):
+        l = "{cache=\"%s\"}" % n
+
+        gauges["pygruta_cache_entries" + l]      = len(c)
+        gauges["pygruta_cache_bytes" + l]        = c.bytes
+        totals["pygruta_cache_hits_total" + l]   = c.hits
+        totals["pygruta_cache_misses_total" + l] = c.misses
+        totals["pygruta_cache_evictions_total" + l] = c.evictions
+
+    return 200, pygruta.metrics.render(gauges, totals)
+
+
+@pygruta.router.get(path="/robots.txt", ctype=TEXT_TYPE)
+def robots_get_handler(gruta, q_path, q_vars):
+    return 200, gruta.template("robots_txt")
+
+
+@pygruta.router.get(path="/twtxt.txt", ctype=TEXT_TYPE)
+def twtxt_get_handler(gruta, q_path, q_vars):
+    return 200, twtxt(gruta, gruta.feed())
+
+
+@pygruta.router.get(path="/style.css", ctype="text/css")
+def style_get_handler(gruta, q_path, q_vars):
+    return 200, gruta.template("css_compact")
 
 
 def twtxt(gruta, story_set):
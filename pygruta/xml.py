@@ -8,6 +8,7 @@
 #   XML generator
 
 import pygruta
+import pygruta.router
 import re
 
 def sitemap(gruta):
@@ -154,43 +155,50 @@ def rss(gruta, story_set, title=None, rel=None):
     return page
 
 
-def get_handler(gruta, q_path, q_vars):
-    """ GET handler for XML files """
+XML_TYPE = "text/xml; charset=utf-8"
+
+@pygruta.router.get(path="/sitemap.xml", ctype=XML_TYPE)
+def sitemap_get_handler(gruta, q_path, q_vars):
+    return 200, sitemap(gruta)
+
+
+@pygruta.router.get(path="/atom.xml", ctype=XML_TYPE)
+def atom_get_handler(gruta, q_path, q_vars):
+    return 200, atom(gruta, gruta.feed())
+
+
+@pygruta.router.get(path="/rss.xml", ctype=XML_TYPE)
+def rss_get_handler(gruta, q_path, q_vars):
+    return 200, rss(gruta, gruta.feed())
+
+
+@pygruta.router.get(pattern=r"^/[^/]+/atom\.xml$", ctype=XML_TYPE)
+def topic_atom_get_handler(gruta, q_path, q_vars):
+    """ an ATOM feed for a topic """
 
     status, body = 0, None
 
-    if q_path == "/sitemap.xml":
-        status = 200
-        body   = sitemap(gruta)
+    topic_id = q_path.split("/")[1]
+    topic = gruta.topic(topic_id)
 
-    elif q_path == "/atom.xml":
+    if topic is not None:
+        num    = int(gruta.template("cfg_index_num"))
         status = 200
-        body   = atom(gruta, gruta.feed())
+        body   = atom(gruta, gruta.story_set(topics=[topic_id], num=num),
+                    subtitle=topic.get("description") or topic.get("name"),
+                    rel="%s/atom.xml" % topic_id)
+    else:
+        status = 404
 
-    elif q_path == "/rss.xml":
-        status = 200
-        body   = rss(gruta, gruta.feed())
-
-    elif re.search("^/[^/]+/atom\.xml$", q_path):
-        # an ATOM feed for a topic
-        topic_id = q_path.split("/")[1]
-        topic = gruta.topic(topic_id)
-
-        if topic is not None:
-            num    = int(gruta.template("cfg_index_num"))
-            status = 200
-            body   = atom(gruta, gruta.story_set(topics=[topic_id], num=num),
-                        subtitle=topic.get("description") or topic.get("name"),
-                        rel="%s/atom.xml" % topic_id)
-        else:
-            status = 404
-
-    elif re.search("^/tag/[^/]+\.xml$", q_path):
-        # an ATOM feed for a tag
-        tag    = q_path.replace("/tag/", "").replace(".xml", "")
-        num    = int(gruta.template("cfg_rss_num"))
-        status = 200
-        body   = atom(gruta, gruta.story_set(tags=[tag], num=num),
-                    subtitle=tag, rel="tag/%s.xml" % tag)
+    return status, body
+
+
+@pygruta.router.get(pattern=r"^/tag/[^/]+\.xml$", ctype=XML_TYPE)
+def tag_atom_get_handler(gruta, q_path, q_vars):
+    """ an ATOM feed for a tag """
+
+    tag    = q_path.replace("/tag/", "").replace(".xml", "")
+    num    = int(gruta.template("cfg_rss_num"))
 
-    return status, body, "text/xml; charset=utf-8"
+    return 200, atom(gruta, gruta.story_set(tags=[tag], num=num),
+                subtitle=tag, rel="tag/%s.xml" % tag)